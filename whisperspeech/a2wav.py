@@ -5,7 +5,7 @@ __all__ = ['Vocoder']
 
 # %% ../nbs/6. Quality-boosting vocoder.ipynb 1
 from vocos import Vocos
-from whisperspeech import inference
+from whisperspeech import inference, telemetry
 import torch
 import torchaudio
 
@@ -24,6 +24,7 @@ class Vocoder:
             return False
 
     @torch.no_grad()
+    @telemetry.stage("vocoder")
     def decode(self, atoks):
         if len(atoks.shape) == 3:
             b,q,t = atoks.shape
@@ -40,7 +41,8 @@ class Vocoder:
         
     def decode_to_file(self, fname, atoks):
         audio = self.decode(atoks)
-        torchaudio.save(fname, audio.cpu(), 24000)
+        with telemetry.stage("io"):
+            torchaudio.save(fname, audio.cpu(), 24000)
         if self.is_notebook():
             from IPython.display import display, HTML, Audio
             display(HTML(f'<a href="{fname}" target="_blank">Listen to {fname}</a>'))
@@ -31,21 +31,16 @@ def benchmark(
     s2a_ctx_n : int = None,
     t2s_ctx_n : int = None,
     iterations = 10,
+    compare_t2s_decoding : bool = False, # compare the T2S tokens/s with different decoding loop modes
 ):
     max_batch_size = max_batch_size or batch_size
 
     pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False)
 
-    if t2s_ctx_n:
-        pipe.t2s.stoks_len = t2s_ctx_n
-        pipe.t2s.decoder.mask = torch.empty(t2s_ctx_n, t2s_ctx_n).fill_(-torch.inf).triu_(1).to(get_compute_device())
-    
+    if t2s_ctx_n: pipe.t2s.limit_context(t2s_ctx_n)
     pipe.t2s.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile)
 
-    if s2a_ctx_n:
-        pipe.s2a.ctx_n = s2a_ctx_n
-        pipe.s2a.decoder.mask = torch.empty(s2a_ctx_n, s2a_ctx_n).fill_(-torch.inf).triu_(1).to(get_compute_device())
-
+    if s2a_ctx_n: pipe.s2a.limit_context(s2a_ctx_n)
     pipe.s2a.optimize(max_batch_size=max_batch_size, torch_compile=not no_torch_compile)
 
     txt = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
@@ -65,3 +60,20 @@ def benchmark(
     s2a_mean, s2a_std = measure(s2a, iterations=iterations)
     print(f"T2S: {t2s_mean:.3f} ± {t2s_std:.3f} s    S2A: {s2a_mean:.3f} ± {s2a_std:.3f} s    Total: {t2s_mean+s2a_mean:.3f} s")
     print(f"     {t/t2s_mean:.2f}x                  {t/s2a_mean:.2f}x                    {t/(t2s_mean+s2a_mean):.2f}x")
+
+    if compare_t2s_decoding:
+        # all the modes run the current decoding loop (not the original one which also checked every step but stopped
+        # only when all the rows ended on the same step), they differ in how often we sync with the host
+        modes = {
+            "stop check every step": dict(stop_check_every=1),
+            "stop check every 8 steps": dict(stop_check_every=8),
+            "4-step graphs, check every 8": dict(stop_check_every=8, decode_steps=4),
+        }
+        # NOTE: this runs without `repetition_penalty`, with it the multi-step graphs also have to carry a copy of the
+        # `seen` mask through every step and the caller marks the tokens again after each graph
+        for name, kwargs in modes.items():
+            # fixed seed so every mode generates the same tokens
+            def t2s(): return pipe.t2s.generate(txt, bs=batch_size, seed=0, show_progress_bar=False, **kwargs)
+            n = t2s().numel() # also serves as warmup
+            mean, std = measure(t2s, iterations=iterations)
+            print(f"T2S {name:>24}: {n/mean:.1f} tokens/s ({mean:.3f} ± {std:.3f} s)")
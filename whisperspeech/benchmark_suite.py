@@ -0,0 +1,179 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/C. Benchmark suite.ipynb.
+
+# %% auto 0
+__all__ = ['benchmark_suite']
+
+# %% ../nbs/C. Benchmark suite.ipynb 3
+import os
+import json
+import time
+import threading
+import platform
+import itertools
+from pathlib import Path
+
+import torch
+from fastcore.script import call_parse
+
+from whisperspeech import inference, telemetry, synthetic
+
+# %% ../nbs/C. Benchmark suite.ipynb 4
+sample_text = "This is the first demo of Whisper Speech, a fully open source text-to-speech model trained by Collabora and Lion on the Juwels supercomputer."
+
+def make_text(length):
+    "Repeats `sample_text` and cuts it at a word boundary to get roughly `length` characters."
+    txt = " ".join([sample_text] * (length // len(sample_text) + 1))
+    return txt[:length].rsplit(" ", 1)[0]
+
+def percentiles(xs, qs=(50, 95, 99)):
+    xs = torch.tensor(xs, dtype=torch.float64)
+    return {f'p{q}': torch.quantile(xs, q / 100).item() for q in qs}
+
+def rss_bytes():
+    "The resident set size of this process (Linux only, `None` elsewhere)."
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+class PeakMemory:
+    """Measures the peak memory use inside a `with` block: the allocated memory on CUDA devices and the process RSS
+    (sampled every `interval` seconds by a background thread, since the kernel peak can't be reset) on the CPU."""
+    def __init__(self, device, interval=0.005):
+        self.device, self.interval = torch.device(device), interval
+        self.peak = None
+
+    def _sample(self):
+        while not self.done.wait(self.interval): self.peak = max(self.peak, rss_bytes())
+
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+        elif rss_bytes() is not None:
+            self.peak, self.done = rss_bytes(), threading.Event()
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.device.type == 'cuda':
+            self.peak = torch.cuda.max_memory_allocated(self.device)
+        elif self.peak is not None:
+            self.done.set()
+            self.thread.join()
+            self.peak = max(self.peak, rss_bytes())
+
+    @property
+    def mb(self):
+        return self.peak / 2**20 if self.peak is not None else None
+
+# %% ../nbs/C. Benchmark suite.ipynb 5
+def pretrained_models(t2s_ref, s2a_ref, device):
+    from whisperspeech.pipeline import Pipeline
+    pipe = Pipeline(t2s_ref=t2s_ref, s2a_ref=s2a_ref, optimize=False, device=device)
+    return pipe.t2s, pipe.s2a
+
+def load_vocoder(device, pretrained):
+    if not pretrained: return synthetic.StubVocoder(device=device)
+    try:
+        from whisperspeech.a2wav import Vocoder
+        return Vocoder(device=device)
+    except Exception as e:
+        print(f"Benchmarking without the vocoder ({e!r})")
+        return None
+
+# %% ../nbs/C. Benchmark suite.ipynb 6
+def run_case(t2s, s2a, vocoder, speaker, txt, bs, cps, cap_stoks, iterations, device):
+    N = min(t2s.stoks_len, int(len(txt) / cps * 25)) if cap_stoks else None
+    results = []
+    def request():
+        first_frame = None
+        steps = 0
+        def step():
+            # the delay pattern completes the first acoustic frame after one step per quantizer
+            nonlocal first_frame, steps
+            steps += 1
+            if steps == s2a.quantizers:
+                telemetry._synchronize()
+                first_frame = time.perf_counter()
+        start = time.perf_counter()
+        with tel.request() as timings:
+            with telemetry.stage("t2s"):
+                stoks = t2s.generate(txt, cps=cps, bs=bs, N=N, show_progress_bar=False)
+            with telemetry.stage("s2a"):
+                atoks = s2a.generate(stoks[0], speaker.unsqueeze(0), bs=bs, step=step, show_progress_bar=False)
+            if vocoder is not None: vocoder.decode(atoks)
+            telemetry.count("stoks", stoks.numel())
+            telemetry.count("atoks", atoks.shape[0] * atoks.shape[-1])
+            telemetry.count("audio_seconds", atoks.shape[0] * atoks.shape[-1] / 75)
+        return timings, first_frame - start if first_frame else None
+
+    tel = telemetry.Telemetry()
+    request() # warmup
+    with PeakMemory(device) as memory:
+        for _ in range(iterations): results.append(request())
+    timings = [t for t,_ in results]
+    first_frame = [x for _,x in results if x is not None]
+    return dict(
+        latency = percentiles([t.total for t in timings]),
+        # when the first acoustic frame is generated (before vocoding)
+        time_to_first_frame = percentiles(first_frame) if first_frame else None,
+        t2s_tokens_per_second = percentiles([t.tokens_per_second('t2s', 'stoks') for t in timings], (50,)),
+        s2a_tokens_per_second = percentiles([t.tokens_per_second('s2a', 'atoks') for t in timings], (50,)),
+        rtf = percentiles([t.rtf for t in timings]),
+        stages = {k: sum(t.stages[k] for t in timings) / len(timings) for k in timings[0].stages},
+        audio_seconds = timings[0].counts['audio_seconds'] / bs,
+        peak_memory_mb = memory.mb,
+    )
+
+# %% ../nbs/C. Benchmark suite.ipynb 7
+@call_parse
+def benchmark_suite(
+    sizes : str = 'micro', # comma separated `_make_model` presets for the randomly initialized models
+    pretrained : bool = False, # benchmark the `t2s_ref` and `s2a_ref` models instead of the random ones
+    t2s_ref : str = 'collabora/whisperspeech:t2s-small-en+pl.model',
+    s2a_ref : str = 'collabora/whisperspeech:s2a-q4-tiny-en+pl.model',
+    text_lengths : str = '50,150,300', # in characters
+    batch_sizes : str = '1,4',
+    dtypes : str = None, # defaults to float16 on GPUs and float32 on the CPU
+    attention_kernels : str = 'auto', # e.g. `auto,math,efficient,flash+efficient` (see `inference.attention_kernel`)
+    no_vocoder : bool = False,
+    no_torch_compile : bool = False,
+    cps : int = 15,
+    iterations : int = 10,
+    device : str = None,
+    output : str = 'benchmark.json',
+):
+    device = device or inference.get_compute_device()
+    dtypes = dtypes or ('float32' if torch.device(device).type == 'cpu' else 'float16')
+    text_lengths = [int(x) for x in text_lengths.split(',')]
+    batch_sizes = [int(x) for x in batch_sizes.split(',')]
+    models = [f'{t2s_ref} {s2a_ref}'] if pretrained else sizes.split(',')
+    vocoder = None if no_vocoder else load_vocoder(device, pretrained)
+
+    report = dict(
+        env = dict(torch=torch.__version__, device=device, platform=platform.platform(),
+                   gpu=torch.cuda.get_device_name(device) if torch.device(device).type == 'cuda' else None,
+                   peak_memory='allocated CUDA memory' if torch.device(device).type == 'cuda' else
+                               'sampled process RSS' if rss_bytes() is not None else 'not measured',
+                   torch_compile=not no_torch_compile, vocoder=type(vocoder).__name__ if vocoder else None, iterations=iterations),
+        results = [],
+    )
+    for model in models:
+        for dtype, kernel in itertools.product(dtypes.split(','), attention_kernels.split(',')):
+            inference.set_attention_kernel(None if kernel == 'auto' else kernel.replace('+', ','))
+            t2s, s2a = pretrained_models(t2s_ref, s2a_ref, device) if pretrained else \
+                (synthetic.make_t2s(model, device=device), synthetic.make_s2a(model, device=device))
+            speaker = torch.randn(192, generator=torch.Generator().manual_seed(0))
+            for m in (t2s, s2a): m.optimize(max_batch_size=max(batch_sizes), dtype=getattr(torch, dtype), torch_compile=not no_torch_compile)
+            for length in text_lengths:
+                for bs in batch_sizes:
+                    r = run_case(t2s, s2a, vocoder, speaker, make_text(length), bs, cps, not pretrained, iterations, device)
+                    report['results'].append(dict(model=model, dtype=dtype, attention_kernel=kernel, text_length=length, batch_size=bs, **r))
+                    print(f"{model:>10} {dtype:>8} {kernel:>8} {length:4d} chars bs={bs:<3d} latency p50 {r['latency']['p50']:.3f} s  "
+                          f"p99 {r['latency']['p99']:.3f} s  RTF {r['rtf']['p50']:.3f}" +
+                          (f"  peak {r['peak_memory_mb']:.0f} MB" if r['peak_memory_mb'] is not None else ""))
+            del t2s, s2a
+    inference.set_attention_kernel(None)
+    Path(output).write_text(json.dumps(report, indent=2))
+    return report
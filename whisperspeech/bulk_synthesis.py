@@ -0,0 +1,143 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/7B. Bulk synthesis.ipynb.
+
+# %% auto 0
+__all__ = ['synthesize']
+
+# %% ../nbs/7B. Bulk synthesis.ipynb 3
+import io
+import json
+import time
+import queue
+from pathlib import Path
+
+import numpy as np
+import torch
+from fastprogress import progress_bar
+from fastcore.script import call_parse
+
+from whisperspeech import utils
+from whisperspeech.pipeline import Pipeline
+
+# %% ../nbs/7B. Bulk synthesis.ipynb 4
+def read_manifest(fname):
+    items = []
+    with open(fname) as f:
+        for i,line in enumerate(f):
+            line = line.rstrip('\n')
+            if not line.strip(): continue
+            item = json.loads(line) if fname.endswith('.jsonl') else dict(text=line)
+            # the line number is a key that stays stable if we rerun the job
+            item.setdefault('key', f'{i:09d}')
+            items.append(item)
+    return items
+
+def flac_bytes(audio, sr=24000):
+    import torchaudio
+    buf = io.BytesIO()
+    torchaudio.save(buf, audio.cpu().float(), sr, format='flac')
+    return buf.getvalue()
+
+def shard_name(output, i):
+    return f'{output}-{i:06d}.tar'
+
+def write_shard(pipe, shard, fname, speaker=None, lang='en', cps=15, batch_size=16, audio=False, no_atoks=False):
+    results = pipe.generate_many([x['text'] for x in shard], speaker=[x.get('speaker', speaker) for x in shard],
+                                 lang=[x.get('lang', lang) for x in shard], cps=[x.get('cps', cps) for x in shard],
+                                 batch_size=batch_size, vocode=audio)
+    with utils.AtomicTarWriter(fname) as sink:
+        for item, r in zip(shard, results):
+            atoks, wav = r if audio else (r, None)
+            sample = {
+                "__key__": item['key'],
+                "txt": item['text'],
+                "json": {k:v for k,v in item.items() if k not in ('key', 'text')},
+            }
+            if not no_atoks: sample["atoks.npy"] = atoks[0].cpu().numpy().astype(np.int16)
+            if wav is not None: sample["flac"] = flac_bytes(wav)
+            sink.write(sample)
+
+# %% ../nbs/7B. Bulk synthesis.ipynb 5
+def worker(rank, device, todo, done, manifest, shard_size, output, pipe_kws, shard_kws, threads=None, make_pipe=Pipeline):
+    """Takes shard numbers from the `todo` queue (until it gets a `None`) and reports the finished ones to `done`.
+    `make_pipe` has to be picklable (e.g. `synthetic.make_pipeline` for testing)."""
+    if threads: torch.set_num_threads(threads)
+    items = read_manifest(manifest)
+    pipe = make_pipe(device=device, **pipe_kws)
+    for i in iter(todo.get, None):
+        start = time.time()
+        shard = items[i*shard_size:(i+1)*shard_size]
+        write_shard(pipe, shard, shard_name(output, i), **shard_kws)
+        done.put((i, rank, len(shard), time.time() - start))
+
+def parse_devices(devices):
+    if devices != 'all': return devices.split(',')
+    if torch.cuda.is_available(): return [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    return ['cpu']
+
+def run_workers(devices, todo, threads=None, **kwargs):
+    """Runs a `worker` on each of the `devices`. They all take shards from a shared queue so the faster ones
+    automatically pick up more work."""
+    ctx = torch.multiprocessing.get_context('spawn')
+    todo_q, done_q = ctx.Queue(), ctx.Queue()
+    for i in todo: todo_q.put(i)
+    for _ in devices: todo_q.put(None)
+    procs = [ctx.Process(target=worker, args=(rank, device, todo_q, done_q), kwargs=dict(threads=threads, **kwargs), daemon=True)
+             for rank, device in enumerate(devices)]
+    for p in procs: p.start()
+
+    def finished():
+        n = 0
+        while n < len(todo):
+            try:
+                yield done_q.get(timeout=1)
+                n += 1
+            except queue.Empty:
+                # if a worker crashed the others still finish the remaining shards, stop when all are gone
+                if not any(p.is_alive() for p in procs): return
+
+    stats = [[0, 0, 0] for _ in devices]
+    for i, rank, samples, seconds in progress_bar(finished(), total=len(todo)):
+        stats[rank] = [stats[rank][0] + 1, stats[rank][1] + samples, stats[rank][2] + seconds]
+    for p in procs: p.join()
+    for rank, (device, (shards, samples, seconds)) in enumerate(zip(devices, stats)):
+        print(f"worker {rank} ({device}): {shards} shards, {samples / max(seconds, 1e-6):.1f} samples/s")
+
+# %% ../nbs/7B. Bulk synthesis.ipynb 6
+@call_parse
+def synthesize(
+    manifest:str, # a text file (one sentence per line) or a JSONL file with `text` (and optionally `key`, `lang`, `cps`, `speaker`) fields
+    output:str, # the output shard prefix
+    t2s_ref:str=None, # T2S model reference
+    s2a_ref:str=None, # S2A model reference
+    speaker:str=None, # the default voice (an audio file)
+    lang:str='en', # the default language
+    cps:float=15, # the default speaking speed (characters per second)
+    shard_size:int=1000, # samples per output shard
+    batch_size:int=16, # sentences synthesized in parallel
+    audio:bool=False, # save the audio (as FLAC) in addition to the acoustic tokens
+    no_atoks:bool=False, # don't save the acoustic tokens
+    torch_compile:bool=False,
+    devices:str=None, # run one worker process per device (e.g. `cuda:0,cuda:1` or `cpu,cpu`), `all` uses every GPU
+    threads:int=None, # CPU threads per worker
+):
+    if no_atoks and not audio: raise ValueError("with `no_atoks` we need `audio`, otherwise there is nothing to save")
+    items = read_manifest(manifest)
+    n_shards = (len(items) + shard_size - 1) // shard_size
+    todo = [i for i in range(n_shards) if not Path(shard_name(output, i)).exists()]
+    if len(todo) < n_shards: print(f"Skipping {n_shards - len(todo)} of {n_shards} shards that are already done")
+    if not todo: return
+
+    pipe_kws = dict(t2s_ref=t2s_ref, s2a_ref=s2a_ref, max_batch_size=batch_size, torch_compile=torch_compile)
+    shard_kws = dict(speaker=speaker, lang=lang, cps=cps, batch_size=batch_size, audio=audio, no_atoks=no_atoks)
+    if devices:
+        del items
+        run_workers(parse_devices(devices), todo, threads=threads, manifest=manifest, shard_size=shard_size,
+                    output=output, pipe_kws=pipe_kws, shard_kws=shard_kws)
+        failed = [i for i in todo if not Path(shard_name(output, i)).exists()]
+        if failed: raise RuntimeError(f"{len(failed)} shards failed (e.g. {shard_name(output, failed[0])}), rerun to retry them")
+        return
+
+    if threads: torch.set_num_threads(threads)
+    pipe = Pipeline(**pipe_kws)
+    for i in progress_bar(todo):
+        write_shard(pipe, items[i*shard_size:(i+1)*shard_size], shard_name(output, i), **shard_kws)
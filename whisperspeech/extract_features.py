@@ -0,0 +1,172 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/3E. Fused feature extraction.ipynb.
+
+# %% auto 0
+__all__ = ['extract_features']
+
+# %% ../nbs/3E. Fused feature extraction.ipynb 3
+import sys
+import time
+from os.path import expanduser
+from contextlib import ExitStack
+
+import numpy as np
+import torch
+
+from fastprogress import progress_bar
+from fastcore.script import call_parse
+
+import webdataset as wds
+from whisperspeech import utils
+from whisperspeech.inference import get_compute_device
+
+# %% ../nbs/3E. Fused feature extraction.ipynb 4
+class StoksExtractor:
+    "Semantic tokens and speaker embeddings (like `extract_stoks.prepare_stoks`)."
+    sr = 16000
+    def __init__(self, vq_model, kind='max', batch_size=64, dir='stoks', device=None):
+        from speechbrain.pretrained import EncoderClassifier
+        from whisperspeech import vq_stoks
+        self.kind, self.batch_size, self.dir = kind, batch_size, dir
+        self.device = device or get_compute_device()
+        self.vq_model = vq_stoks.RQBottleneckTransformer.load_model(vq_model).to(self.device)
+        self.vq_model.ensure_whisper()
+        self.spk_classifier = EncoderClassifier.from_hparams("speechbrain/spkrec-ecapa-voxceleb",
+                                                             savedir=expanduser("~/.cache/speechbrain/"),
+                                                             run_opts = {"device": self.device})
+
+    def __call__(self, chunks):
+        rpad_ss = np.array([x['rpad_s'] for x in chunks])
+        samples16k = torch.stack([x['samples_16k'] for x in chunks]).to(self.device).to(torch.float16)
+        stoks = self.vq_model.encode_audio(samples16k).cpu().numpy().astype(np.int16)
+        spk_embs = self.spk_classifier.encode_batch(
+            samples16k, wav_lens=torch.tensor(30 - rpad_ss, dtype=torch.float)/30)[:,0,:].cpu().numpy()
+        return [{"__key__": x['__key__'], "stoks.npy": _stoks[:int((30-rpad_s) * 25 + .5)], "spk_emb.npy": spk_emb}
+                for x, rpad_s, _stoks, spk_emb in zip(chunks, rpad_ss, stoks, spk_embs)]
+
+class AtoksExtractor:
+    "EnCodec acoustic tokens (like `prepare_s2a_atoks.prepare_atoks`)."
+    sr = 24000
+    def __init__(self, bandwidth=3, kind='max', batch_size=4, dir='encodec-3kbps', device=None):
+        from whisperspeech.prepare_s2a_atoks import load_model
+        self.kind, self.batch_size, self.dir = kind, batch_size, dir
+        self.device = device or get_compute_device()
+        self.amodel = load_model().to(self.device)
+        self.amodel.set_target_bandwidth(bandwidth)
+
+    def __call__(self, chunks):
+        csamples = torch.stack([x['samples_24k'] for x in chunks]).to(self.device).unsqueeze(1)
+        atokss = self.amodel.encode(csamples)[0][0].cpu().numpy().astype(np.int16)
+        return [{"__key__": x['__key__'], "atoks.npy": atoks[:,:int((30-x['rpad_s']) * 75 + 0.5)]}
+                for x, atoks in zip(chunks, atokss)]
+
+class MetricsExtractor:
+    "SNR and C50 estimates (like `extract_metrics.prepare_metrics`), it works on the original sampling rate."
+    sr = None
+    def __init__(self, kind='max', dir='snr-c50', device=None):
+        from pyannote.audio import Model
+        from brouhaha.pipeline import RegressiveActivityDetectionPipeline
+        self.kind, self.batch_size, self.dir = kind, 1, dir
+        self.device = device or get_compute_device()
+        model = Model.from_pretrained(expanduser('~/.cache/brouhaha.ckpt'), strict=False)
+        self.snr_pipeline = RegressiveActivityDetectionPipeline(segmentation=model).to(torch.device(self.device))
+
+    def __call__(self, chunks):
+        results = []
+        for x in chunks:
+            snd, gain_shift = x['samples'], x['gain_shift.npy']
+            if x['rpad'] > 0: snd = snd[:-x['rpad']]
+            snd = (snd - gain_shift[1]) * gain_shift[0]
+            res = self.snr_pipeline({"sample_rate": x['sample_rate'], "waveform": snd.unsqueeze(0).to(self.device)})
+            results.append({"__key__": x['__key__'], "snr_c50.npy": np.array([res['snr'].mean(), res['c50'].mean()])})
+        return results
+
+class TxtExtractor:
+    "Transcripts (like `prepare_t2s_txts.prepare_txt`)."
+    sr = 16000
+    def __init__(self, transcription_model='medium', language='en', kind='raw', batch_size=16, dir=None, device=None):
+        from whisperspeech.prepare_t2s_txts import Transcriber
+        self.kind, self.batch_size = kind, batch_size
+        self.dir = dir or f'{transcription_model}-txt'
+        self.device = device or get_compute_device()
+        self.transcriber = Transcriber(transcription_model, lang=language)
+
+    def __call__(self, chunks):
+        txts = self.transcriber.transcribe(torch.stack([x['samples_16k'] for x in chunks]).to(self.device))
+        return [{"__key__": x['__key__'], "txt": txt} for x, txt in zip(chunks, txts)]
+
+# %% ../nbs/3E. Fused feature extraction.ipynb 5
+def chunk_all_kinds(stream, kinds):
+    """Splits every audio file into the chunks of all the `kinds` (a dict from the `mvad` kind to the set of sampling
+    rates the extractors need).
+
+    The file is decoded only once and we only pass the keys used by the extractors to the main process."""
+    for s in stream:
+        s['audio'].load()
+        for kind, rates in kinds.items():
+            s['vad.npy'], s['spk_emb.npy'] = s[f'{kind}.vad.npy'], s[f'{kind}.spk_emb.npy']
+            for chunk in utils.split_to_chunks([s], copy_keys=['gain_shift.npy'], split_keys=['spk_emb.npy']):
+                x = {k:chunk[k] for k in ['__key__', 'rpad', 'rpad_s', 'samples', 'sample_rate', 'gain_shift.npy']}
+                x['kind'] = kind
+                for sr in rates: x[f'samples_{sr//1000}k'] = utils.resample(chunk['samples'], chunk['sample_rate'], sr)
+                yield x
+
+# %% ../nbs/3E. Fused feature extraction.ipynb 7
+@call_parse
+def extract_features(
+    input:str,           # audio file webdataset file path
+    extractors:str='stoks,atoks,snr_c50,txt', # comma separated list of the features to extract
+    n_samples:int=None,  # process a limited amount of samples
+    vq_model:str="collabora/spear-tts-pytorch:whisper-vq-stoks-v2.model", # the model path (use repo_id:filename to download it from hugginface)
+    stoks_kind:str="max",# could be eq to get more uniform chunk lengths
+    stoks_dir:str="stoks",
+    stoks_batch_size:int=64,
+    atoks_batch_size:int=4,
+    bandwidth:float=3,
+    transcription_model:str="medium",
+    language:str="en",
+    txt_batch_size:int=16,
+):
+    make = {
+        'stoks': lambda: StoksExtractor(vq_model, kind=stoks_kind, batch_size=stoks_batch_size, dir=stoks_dir),
+        'atoks': lambda: AtoksExtractor(bandwidth, batch_size=atoks_batch_size),
+        'snr_c50': lambda: MetricsExtractor(),
+        'txt': lambda: TxtExtractor(transcription_model, language, batch_size=txt_batch_size),
+    }
+    for name in extractors.split(','):
+        if name not in make: raise ValueError(f"unknown extractor: {name} (possible values: {', '.join(make)})")
+    extractors = [make[name]() for name in extractors.split(',')]
+    kinds = {}
+    for e in extractors: kinds.setdefault(e.kind, set()).update([e.sr] if e.sr else [])
+
+    total = n_samples
+    if total is None:
+        start = time.time()
+        ds = wds.WebDataset([utils.derived_name(input, 'mvad')]).decode()
+        total = sum([len(x[f'{kind}.spk_emb.npy']) for x in ds for kind in kinds])
+        print(f"Counting {total} chunks: {time.time()-start:.2f}")
+
+    ds = wds.WebDataset([input]).compose(
+        wds.decode(utils.lazy_audio),
+        utils.find_audio,
+        utils.merge_in(utils.derived_dataset('mvad')),
+        lambda x: chunk_all_kinds(x, kinds),
+    )
+    dl = wds.WebLoader(ds, num_workers=1, batch_size=None)
+    if n_samples: dl = dl.slice(n_samples)
+
+    with ExitStack() as stack:
+        sinks = [stack.enter_context(utils.AtomicTarWriter(utils.derived_name(input, e.dir), throwaway=n_samples is not None))
+                 for e in extractors]
+        batches = [[] for _ in extractors]
+        def flush(i):
+            with torch.no_grad():
+                for s in extractors[i](batches[i]): sinks[i].write(s)
+            batches[i] = []
+        for chunk in progress_bar(dl, total=total):
+            for i, e in enumerate(extractors):
+                if chunk['kind'] != e.kind: continue
+                batches[i].append(chunk)
+                if len(batches[i]) >= e.batch_size: flush(i)
+        for i in range(len(extractors)):
+            if batches[i]: flush(i)
+        sys.stdout.write("\n")
@@ -1,9 +1,13 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Common inference utilities.ipynb.
 
 # %% auto 0
-__all__ = ['get_compute_device']
+__all__ = ['get_compute_device', 'PromptState', 'prompt_toks', 'restore_prompt_states', 'kv_cache_bytes', 'parse_memory_size',
+           'fit_memory_budget']
 
 # %% ../nbs/D. Common inference utilities.ipynb 1
+import os
+import re
+import dataclasses
 import torch
 import torch.nn.functional as F
 from huggingface_hub import hf_hub_download
@@ -38,29 +42,129 @@ def load_model(ref=None, spec=None, device='cpu'):
     return torch.load(local_filename, map_location=device)
 
 # %% ../nbs/D. Common inference utilities.ipynb 5
-def inference_context():
-    if torch.cuda.is_available():
-        return torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False, enable_math=True)
-    else:
-        return nullcontext()
+# the scaled_dot_product_attention kernels used for generation: `None` lets PyTorch pick the fastest one that supports
+# the inputs, otherwise a comma separated list of `flash`, `efficient`, `cudnn` and `math`
+# (decoding with a KV cache needs an attention mask so `flash` alone will fail there, use e.g. `flash,efficient`)
+attention_kernel = None
+
+sdpa_backends = dict(flash='FLASH_ATTENTION', efficient='EFFICIENT_ATTENTION', cudnn='CUDNN_ATTENTION', math='MATH')
+
+def set_attention_kernel(kernel):
+    global attention_kernel
+    if kernel is not None:
+        unknown = [x for x in kernel.split(',') if x not in sdpa_backends]
+        if unknown: raise ValueError(f"unknown attention kernels {unknown}, use one of {list(sdpa_backends)}")
+    attention_kernel = kernel
+
+def inference_context(kernel=None):
+    kernel = kernel or attention_kernel
+    if kernel is None: return nullcontext()
+    names = kernel.split(',')
+    try:
+        from torch.nn.attention import sdpa_kernel, SDPBackend
+    except ImportError: # PyTorch < 2.3
+        return torch.backends.cuda.sdp_kernel(enable_flash='flash' in names, enable_mem_efficient='efficient' in names,
+                                              enable_math='math' in names)
+    return sdpa_kernel([getattr(SDPBackend, sdpa_backends[x]) for x in names])
+
+# the sampling code moved to `whisperspeech.sampling`, these names are kept for backwards compatibility
+from whisperspeech.sampling import multinomial_sample_one_no_sync, logits_to_probs, sample
+
+def trim_silence(atoks, keep=3):
+    """Removes the trailing silence (a run of frames where the first quantizer keeps repeating the same code)
+    from acoustic tokens, leaving `keep` frames to avoid cutting the audio abruptly."""
+    q0 = atoks[...,0,:].reshape(-1, atoks.shape[-1])
+    run = (q0 == q0[:,-1:]).flip(-1).cumprod(-1).sum(-1)
+    return atoks[...,:atoks.shape[-1] - max(int(run.min()) - keep, 0)]
+
+# %% ../nbs/D. Common inference utilities.ipynb 6
+@dataclasses.dataclass
+class PromptState:
+    """The decoder self-attention KV caches after prefilling a voice prompt.
+
+    Capture it once per voice with the `prompt_state` method of a model and pass it to `generate(prompt_state=...)`
+    so every request only has to prefill the last prompt token. The cached keys and values were computed against
+    the encoder output used during capture (cross-attention), so the results are close to, but not bit-identical
+    with, passing the prompt tokens to each request."""
+    toks: torch.Tensor # the prompt tokens with a batch dimension of 1
+    kv: list # a `(k, v)` pair for every decoder layer, each shaped `(n_head, length, head_width)`
+
+    @property
+    def length(self): return self.kv[0][0].shape[-2]
+
+    @classmethod
+    def capture(cls, decoder, toks, length, slot=0):
+        return cls(toks.clone(), [(l.attn.k_cache[slot,:,:length].clone(), l.attn.v_cache[slot,:,:length].clone())
+                                  for l in decoder.layers])
+
+    def restore(self, decoder, slots):
+        for l,(k,v) in zip(decoder.layers, self.kv):
+            l.attn.k_cache[slots,:,:self.length] = k
+            l.attn.v_cache[slots,:,:self.length] = v
+
+def prompt_toks(states):
+    "The prompt tokens of a `PromptState` (or a list of states, one per batch row)."
+    if not isinstance(states, list): states = [states]
+    return torch.cat([s.toks for s in states])
+
+def restore_prompt_states(decoder, states, bs):
+    """Copies a `PromptState` into the first `bs` batch slots of the KV caches (or a list of states into their
+    respective slots) and returns the number of restored positions."""
+    if not isinstance(states, list):
+        states.restore(decoder, slice(0, bs))
+        return states.length
+    assert len(states) == bs and len(set(s.length for s in states)) == 1, "we need one state per row, all of the same length"
+    for i,s in enumerate(states): s.restore(decoder, i)
+    return states[0].length
 
-# from https://github.com/pytorch-labs/gpt-fast/blob/main/generate.py
-def multinomial_sample_one_no_sync(probs_sort): # Does multinomial sampling without a cuda synchronization
-    q = torch.empty_like(probs_sort).exponential_(1)
-    return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int)
+# %% ../nbs/D. Common inference utilities.ipynb 7
+def kv_cache_bytes(decoder, max_batch_size, ctx_n, cross_n, dtype=torch.float16):
+    """The memory needed by the self- and cross-attention KV caches allocated in `setup_kv_cache`."""
+    item = torch.finfo(dtype).bits // 8
+    width = decoder.layers[0].attn.kv_width
+    return len(decoder.layers) * 2 * max_batch_size * width * (ctx_n + cross_n) * item
 
-def logits_to_probs(logits, T=1.0, top_k=None):
-    logits = logits / max(T, 1e-5)
+def parse_memory_size(x, device=None):
+    """Converts `8GB`, `512MiB` or a number of bytes into bytes. `auto` uses 90% of the free memory on `device`."""
+    if not isinstance(x, str): return int(x)
+    if x == 'auto':
+        device = str(device or get_compute_device())
+        if device.startswith('cuda'): free = torch.cuda.mem_get_info(device)[0]
+        else: free = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') # the CPU and MPS use the system memory
+        return int(free * .9)
+    m = re.fullmatch(r'\s*([\d.]+)\s*([kmgt]?)(i?b)?\s*', x.lower())
+    if m is None: raise ValueError(f"can't parse the memory size: {x!r}")
+    return int(float(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2) or ' '))
 
-    if top_k is not None:
-        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-        pivot = v.select(-1, -1).unsqueeze(-1)
-        logits = torch.where(logits < pivot, -float("Inf"), logits)
+def fit_memory_budget(t2s, s2a, budget, dtype=torch.float16, max_batch_size=64, headroom=.2, step=25):
+    """Picks the largest batch size and T2S/S2A context lengths whose weights and KV caches fit into `budget` bytes.
 
-    probs = torch.nn.functional.softmax(logits, dim=-1)
-    return probs
+    We prefer the full context (the longest utterance the models can generate) and only shorten it (keeping the
+    ratio between the semantic and acoustic token rates) if even a single sample does not fit. The `headroom` fraction
+    of the budget is left for activations and the allocator.
 
-def sample(logits, T=1.0, top_k=None):
-    probs = logits_to_probs(logits, T, top_k)
-    idx_next = multinomial_sample_one_no_sync(probs)
-    return idx_next
+    If the models are on different devices each of them has to fit into the budget of its own device (`budget` can
+    also be a dict with a separate budget for every device)."""
+    item = torch.finfo(dtype).bits // 8
+    n_max = t2s.__stored_args__['stoks_len']
+    ratio = s2a.__stored_args__['ctx_n'] / n_max
+    kv = {t2s: lambda bs, n: t2s.kv_cache_bytes(bs, dtype, n), s2a: lambda bs, n: s2a.kv_cache_bytes(bs, dtype, int(n * ratio))}
+    devices = {}
+    for m in (t2s, s2a): devices.setdefault(str(m.device), []).append(m)
+    if not isinstance(budget, dict): budget = {d: budget for d in devices}
+    def need(device, bs, n): return sum(sum(p.numel() for p in m.parameters()) * item + kv[m](bs, n) for m in devices[device])
+    def fits(bs, n): return all(need(d, bs, n) <= budget[d] * (1 - headroom) for d in devices)
+    for n in range(n_max, 0, -step):
+        bs = max_batch_size
+        while bs > 0 and not fits(bs, n): bs //= 2
+        if bs > 0:
+            # binary search between the power of two that fits and the next one
+            lo, hi = bs, min(bs * 2, max_batch_size + 1)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if fits(mid, n): lo = mid
+                else: hi = mid
+            return dict(max_batch_size=lo, t2s_stoks_len=n, s2a_ctx_n=int(n * ratio))
+    d = next(d for d in devices if need(d, 1, step) > budget[d] * (1 - headroom))
+    raise ValueError(f"the models need at least {need(d, 1, step) / (1 - headroom) / 2**30:.2f} GiB of memory on {d}, "
+                     f"the budget is {budget[d] / 2**30:.2f} GiB")
@@ -2,12 +2,14 @@
 
 # %% auto 0
 __all__ = ['LayerNorm', 'LinearHead', 'QueryHead', 'init_transformer', 'sinusoids', 'MultiHeadAttention',
-           'ResidualAttentionBlock', 'BaseDecoder', 'EmbeddingProjector', 'FlexEmbeddings']
+           'ResidualAttentionBlock', 'BaseDecoder', 'pool_kv_heads', 'convert_to_gqa', 'EmbeddingProjector',
+           'FlexEmbeddings']
 
 # %% ../nbs/A. Neural modules.ipynb 2
 import torch
 import numpy as np
 import math
+import dataclasses
 
 from torch import Tensor, nn
 import torch.nn.functional as F
@@ -15,6 +17,9 @@ from typing import Dict, Iterable, Optional
 
 # import xformers.ops as xops
 
+# `enable_gqa` was added in PyTorch 2.5
+_sdpa_gqa = 'enable_gqa' in (F.scaled_dot_product_attention.__doc__ or '')
+
 # %% ../nbs/A. Neural modules.ipynb 3
 # Code in this file is mostly borrowed from
 # https://github.com/openai/whisper/blob/main/whisper/model.py
@@ -53,14 +58,18 @@ def sinusoids(length, channels, max_timescale=10000):
 
 # %% ../nbs/A. Neural modules.ipynb 5
 class MultiHeadAttention(nn.Module):
-    def __init__(self, n_state: int, n_head: int, qk_scale: float = 1, rope: bool = False, cross=False):
+    def __init__(self, n_state: int, n_head: int, qk_scale: float = 1, rope: bool = False, cross=False,
+                 n_kv_head: int = None):
         super().__init__()
         self.n_state = n_state
         self.n_head = n_head
+        # grouped-query attention: every key/value head is shared by `n_head // n_kv_head` query heads (1 is MQA)
+        self.n_kv_head = n_kv_head or n_head
+        assert n_head % self.n_kv_head == 0, "n_head has to be divisible by n_kv_head"
         self.sqrt_qk_scale = math.sqrt(qk_scale)
         self.query = QueryHead(n_state, n_state)
-        self.key = nn.Linear(n_state, n_state, bias=False)
-        self.value = nn.Linear(n_state, n_state)
+        self.key = nn.Linear(n_state, self.kv_width, bias=False)
+        self.value = nn.Linear(n_state, self.kv_width)
         self.out = nn.Linear(n_state, n_state)
         self.cross = cross
         self.query_subsampling = 1
@@ -69,6 +78,9 @@ class MultiHeadAttention(nn.Module):
         self.cached_kvx = None
         self.register_buffer('k_cache', None)
         self.register_buffer('v_cache', None)
+        # stacked (cos, sin) rotary tables for the query and key positions (see `setup_kv_cache`)
+        self.register_buffer('rope_q', None, persistent=False)
+        self.register_buffer('rope_k', None, persistent=False)
         
         self.rotary = None
         if rope:
@@ -76,24 +88,29 @@ class MultiHeadAttention(nn.Module):
         self.qkv = None
         self.kv = None
 
-    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32):
-        cache_shape = (max_batch_size, self.n_head, max_seq_len, self.n_state//self.n_head)
+    @property
+    def kv_width(self): return self.n_state // self.n_head * self.n_kv_head
+
+    def setup_kv_cache(self, max_batch_size, max_seq_len, dtype=torch.float32, max_q_len=None):
+        cache_shape = (max_batch_size, self.n_kv_head, max_seq_len, self.n_state//self.n_head)
         self.k_cache = torch.zeros(cache_shape, dtype=dtype, device=self.key.weight.device)
         self.v_cache = torch.zeros(cache_shape, dtype=dtype, device=self.value.weight.device)
+        if self.rotary:
+            # with the subsampling already applied, so rotating the queries and keys is just a gather
+            self.rope_q = self.rotary.table(max_q_len or max_seq_len, self.query_subsampling, dtype)
+            self.rope_k = self.rotary.table(max_seq_len, self.key_subsampling, dtype)
 
     def merge_linears(self, layers, mults):
-        bias = [x.bias for x in layers if x.bias is not None][0]
-        din, dout = layers[0].weight.shape
-        new = nn.Linear(din, len(layers) * dout).to(layers[0].weight.device)
+        new = nn.Linear(layers[0].weight.shape[1], sum(x.weight.shape[0] for x in layers)).to(layers[0].weight.device)
         with torch.no_grad():
             new.weight[:] = torch.cat([x.weight * m for x,m in zip(layers, mults)])
-            new.bias[:] = torch.cat([torch.zeros_like(bias) if x.bias is None else x.bias * m for x, m in zip(layers, mults)])
+            new.bias[:] = torch.cat([x.weight.new_zeros(x.weight.shape[0]) if x.bias is None else x.bias * m for x, m in zip(layers, mults)])
         return new
 
     def convert_for_eval(self):
         if self.qkv or self.kv: raise AttributeError("already converted")
         
-        self.odim = self.key.weight.shape[1]
+        self.odim = [x.weight.shape[0] for x in (self.query, self.key, self.value)]
         if self.cross:
             self.q = self.merge_linears([self.query], [self.sqrt_qk_scale])
             self.kv = self.merge_linears([self.key, self.value],
@@ -102,9 +119,11 @@ class MultiHeadAttention(nn.Module):
             self.qkv = self.merge_linears([self.query, self.key, self.value],
                                           [self.sqrt_qk_scale, self.sqrt_qk_scale, 1])
         
-    def split_heads(self, x, x_positions, rope=False, subsampling=1):
-        x = x.view(*x.shape[:2], self.n_head, -1)
-        if rope:
+    def split_heads(self, x, x_positions, rope=False, subsampling=1, table=None):
+        x = x.view(*x.shape[:2], -1, self.n_state // self.n_head)
+        if table is not None:
+            x = rope_rotate(x, x_positions, *table)
+        elif rope:
             x = rope_rotate(x, x_positions * subsampling, *self.rotary(x))
         return x.permute(0, 2, 1, 3)
 
@@ -123,16 +142,16 @@ class MultiHeadAttention(nn.Module):
             q,k,v = self.qkv(qx).split(self.odim, dim=-1)
         elif self.kv:
             q = self.q(qx)
-            k,v = self.kv(kvx).split(self.odim, dim=-1)
+            k,v = self.kv(kvx).split(self.odim[1:], dim=-1)
         else:
             q,k,v = None,None,None
         
         if q is None: q = self.query(qx) * self.sqrt_qk_scale
-        q = self.split_heads(q, q_positions, rope = self.rotary, subsampling = self.query_subsampling)
+        q = self.split_heads(q, q_positions, rope = self.rotary, subsampling = self.query_subsampling, table = self.rope_q)
 
         if kvx is not self.cached_kvx:
             if k is None: k = self.key(kvx) * self.sqrt_qk_scale
-            k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling)
+            k = self.split_heads(k, kv_positions, rope = self.rotary, subsampling = self.key_subsampling, table = self.rope_k)
             if v is None: v = self.value(kvx)
             v = self.split_heads(v, kv_positions)
             if self.k_cache is not None:
@@ -144,9 +163,27 @@ class MultiHeadAttention(nn.Module):
 
         if mask is not None:
             mask = mask[q_positions,:k.shape[-2]]
-            
-        wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
-        
+        elif causal and self.k_cache is not None:
+            # the queries start at an offset into the (fixed size) cache so `is_causal` would mask the wrong keys,
+            # instead we compute a small (q_len, cache_len) boolean mask from the positions, this also hides the unused
+            # cache slots and keeps the shapes static for CUDA graphs
+            mask = torch.arange(k.shape[-2], device=q.device) <= q_positions[:,None]
+            causal = False
+
+        if self.n_kv_head == self.n_head:
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal)
+        elif _sdpa_gqa:
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0, is_causal=causal, enable_gqa=True)
+        else:
+            # fold the query heads that share a K/V head into the sequence dimension so we never copy the K/V
+            B, _, q_len, D = q.shape
+            group = self.n_head // self.n_kv_head
+            if causal: mask = torch.ones(q_len, k.shape[-2], dtype=torch.bool, device=q.device).tril()
+            if mask is not None: mask = mask.repeat(group, 1)
+            q = q.reshape(B, self.n_kv_head, group * q_len, D)
+            wv = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0)
+            wv = wv.view(B, self.n_head, q_len, D)
+
         return self.out(wv.permute(0, 2, 1, 3).flatten(start_dim=2))
 
 # %% ../nbs/A. Neural modules.ipynb 6
@@ -157,6 +194,7 @@ import torch
 class Rotary(torch.nn.Module):
     def __init__(self, dim, base=10000):
         super().__init__()
+        self.dim, self.base = dim, base
         inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2).float() / dim))
         self.register_buffer("inv_freq", inv_freq)
         self.seq_len_cached = None
@@ -176,6 +214,14 @@ class Rotary(torch.nn.Module):
             self.sin_cached = emb.sin()[None, :, None, :]
         return self.cos_cached, self.sin_cached
 
+    def table(self, length, subsampling=1, dtype=torch.float32):
+        "The stacked `(cos, sin)` for positions `0..length-1` (multiplied by `subsampling`), computed in float32."
+        device = self.inv_freq.device
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=device).float() / self.dim))
+        t = torch.arange(length, device=device).float() * subsampling
+        emb = torch.cat([torch.outer(t, inv_freq)] * 2, dim=-1)
+        return torch.stack([emb.cos(), emb.sin()])[:, None, :, None, :].to(dtype)
+
 
 # rotary pos emb helpers:
 def rotate_half(x):
@@ -190,13 +236,13 @@ def rope_rotate(x, positions, cos, sin):
 # %% ../nbs/A. Neural modules.ipynb 7
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, n_state: int, n_head: int, cross_attention: bool = False, rope: bool = False,
-                 qk_scale: float = 1, ffn_mult: int = 4):
+                 qk_scale: float = 1, ffn_mult: int = 4, n_kv_head: int = None):
         super().__init__()
-        self.attn = MultiHeadAttention(n_state, n_head, qk_scale=qk_scale, rope=rope)
+        self.attn = MultiHeadAttention(n_state, n_head, qk_scale=qk_scale, rope=rope, n_kv_head=n_kv_head)
         self.attn_ln = LayerNorm(n_state)
 
         self.cross_attn = (
-            MultiHeadAttention(n_state, n_head, qk_scale=qk_scale, rope=rope, cross=True) if cross_attention else None
+            MultiHeadAttention(n_state, n_head, qk_scale=qk_scale, rope=rope, cross=True, n_kv_head=n_kv_head) if cross_attention else None
         )
         self.cross_attn_ln = LayerNorm(n_state) if cross_attention else None
 
@@ -209,7 +255,7 @@ class ResidualAttentionBlock(nn.Module):
     def setup_kv_cache(self, max_batch_size, max_seq_len, max_cross_seq_len=None):
         self.attn.setup_kv_cache(max_batch_size, max_seq_len)
         if self.cross_attn:
-            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len)
+            self.cross_attn.setup_kv_cache(max_batch_size, max_cross_seq_len, max_q_len=max_seq_len)
     
     def forward(
         self,
@@ -230,30 +276,54 @@ class ResidualAttentionBlock(nn.Module):
 
 # %% ../nbs/A. Neural modules.ipynb 8
 class BaseDecoder(nn.Module):
-    def __init__(self, depth=6, n_head=6, width=384, qk_scale=1, ffn_mult=4, length=2250, rope=False):
+    def __init__(self, depth=6, n_head=6, width=384, qk_scale=1, ffn_mult=4, rope=False, n_kv_head=None):
         super().__init__()
-        self.length = length
         self.width = width
         self.layers = nn.ModuleList([
             ResidualAttentionBlock(
-                self.width, n_head, qk_scale=qk_scale, ffn_mult=ffn_mult, cross_attention=True, rope=rope
+                self.width, n_head, qk_scale=qk_scale, ffn_mult=ffn_mult, cross_attention=True, rope=rope, n_kv_head=n_kv_head
             ) for _ in range(math.floor(depth))
         ])
 
         self.ln_post = LayerNorm(width)
-        
-        mask = torch.empty(length, length).fill_(-torch.inf).triu_(1)
-        self.register_buffer("mask", mask, persistent=False)
 
     def forward(self, x, x_positions, xenc, xenc_positions):
         for i,l in enumerate(self.layers):
-            x = l(x, x_positions, xenc, xenc_positions, causal=self.training, mask=self.mask if not self.training else None)
+            x = l(x, x_positions, xenc, xenc_positions, causal=True)
 
         x = self.ln_post(x)
 
         return x
 
 # %% ../nbs/A. Neural modules.ipynb 9
+def pool_kv_heads(attn, n_kv_head):
+    "Mean-pools the key and value heads of a `MultiHeadAttention` layer into `n_kv_head` groups."
+    assert attn.qkv is None and attn.kv is None, "please convert the model before calling `optimize`"
+    assert attn.n_kv_head % n_kv_head == 0, "we can only merge existing groups of heads"
+    head_width = attn.n_state // attn.n_head
+    def pool(x): return x.reshape(n_kv_head, -1, head_width, *x.shape[1:]).mean(1).flatten(0, 1)
+    for name in ('key', 'value'):
+        old = getattr(attn, name)
+        new = nn.Linear(attn.n_state, n_kv_head * head_width, bias=old.bias is not None).to(old.weight)
+        with torch.no_grad():
+            new.weight[:] = pool(old.weight)
+            if old.bias is not None: new.bias[:] = pool(old.bias)
+        # keep the μP optimizer settings
+        for k in ('lr_scale', 'no_weight_decay'):
+            if hasattr(old, k): setattr(new, k, getattr(old, k))
+        setattr(attn, name, new)
+    attn.n_kv_head = n_kv_head
+
+def convert_to_gqa(model, n_kv_head):
+    """Converts the decoder of a trained T2S or S2A model to grouped-query attention (`n_kv_head=1` is multi-query
+    attention) by mean-pooling the key and value heads in every group. The model should be fine-tuned for a while
+    afterwards (uptraining), `save_model` stores the new setting in the tunables."""
+    for m in model.decoder.modules():
+        if isinstance(m, MultiHeadAttention): pool_kv_heads(m, n_kv_head)
+    model.tunables = dataclasses.replace(model.tunables, kv_heads=n_kv_head)
+    return model
+
+# %% ../nbs/A. Neural modules.ipynb 12
 class EmbeddingProjector(nn.Linear):
     pass
 
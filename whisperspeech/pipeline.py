@@ -9,11 +9,28 @@ import torch
 from whisperspeech.t2s_up_wds_mlang_enclm import TSARTransformer
 from whisperspeech.s2a_delar_mup_wds_mlang import SADelARTransformer
 from whisperspeech.a2wav import Vocoder
-from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond
+from whisperspeech import inference, s2a_delar_mup_wds_mlang_cond, telemetry
 import traceback
+import itertools
+import re
+import queue
+import threading
 from pathlib import Path
+from contextlib import nullcontext
 
 # %% ../nbs/7. Pipeline.ipynb 2
+def _run_stage(fun, inq, outq, stop):
+    # exceptions are passed down the pipeline so the consumer can raise them,
+    # after `stop` is set we only drain the input queue so the upstream stages can finish
+    for x in iter(inq.get, None):
+        if stop.is_set(): continue
+        if not isinstance(x, Exception):
+            try: x = fun(x)
+            except Exception as e: x = e
+        outq.put(x)
+    outq.put(None)
+
+# %% ../nbs/7. Pipeline.ipynb 3
 class Pipeline:
     default_speaker = torch.tensor(
        [-0.2929, -0.4503,  0.4155, -0.1417,  0.0473, -0.1624, -0.2322,  0.7071,
@@ -42,37 +59,57 @@ class Pipeline:
          0.2702,  0.1699, -0.1443, -0.9614,  0.3261,  0.1718,  0.3545, -0.0686]
     )
     
-    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None):
+    def __init__(self, t2s_ref=None, s2a_ref=None, optimize=True, torch_compile=False, device=None, telemetry=None,
+                 t2s=None, s2a=None, vocoder=None, max_batch_size=1, t2s_device=None, s2a_device=None, vocoder_device=None,
+                 memory_budget=None):
         if device is None: device = inference.get_compute_device()
         self.device = device
-        args = dict(device = device)
+        # each model can also be placed on a different device (see `generate_pipelined`)
+        t2s_device, s2a_device, vocoder_device = [x or device for x in (t2s_device, s2a_device, vocoder_device)]
+        self.max_batch_size = max_batch_size # the batch size `generate_many` can use
+        self.telemetry = telemetry # a `telemetry.Telemetry` instance to collect per-request timings
+        args = dict(device = t2s_device)
         try:
-            if t2s_ref:
-                args["ref"] = t2s_ref
-            self.t2s = TSARTransformer.load_model(**args)  # use obtained compute device
-            if optimize: self.t2s.optimize(torch_compile=torch_compile)
+            if t2s is None:
+                if t2s_ref:
+                    args["ref"] = t2s_ref
+                t2s = TSARTransformer.load_model(**args)  # use obtained compute device
+            self.t2s = t2s
         except:
             print("Failed to load the T2S model:")
             print(traceback.format_exc())
-        args = dict(device = device)
+        args = dict(device = s2a_device)
         try:
-            if s2a_ref:
-                spec = inference.load_model(ref=s2a_ref, device=device)
-                if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
-                    cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
-                    args['spec'] = spec
+            if s2a is None:
+                if s2a_ref:
+                    spec = inference.load_model(ref=s2a_ref, device=s2a_device)
+                    if [x for x in spec['state_dict'].keys() if x.startswith('cond_embeddings.')]:
+                        cls = s2a_delar_mup_wds_mlang_cond.SADelARTransformer
+                        args['spec'] = spec
+                    else:
+                        cls = SADelARTransformer
+                        args['spec'] = spec
                 else:
                     cls = SADelARTransformer
-                    args['spec'] = spec
-            else:
-                cls = SADelARTransformer
-            self.s2a = cls.load_model(**args)  # use obtained compute device
-            if optimize: self.s2a.optimize(torch_compile=torch_compile)
+                s2a = cls.load_model(**args)  # use obtained compute device
+            self.s2a = s2a
         except:
             print("Failed to load the S2A model:")
             print(traceback.format_exc())
 
-        self.vocoder = Vocoder(device=device)
+        if memory_budget is not None:
+            # e.g. `8GB` or `auto`, overrides `max_batch_size` and shortens the contexts if needed
+            # the models may be on different devices, each of them gets its own budget
+            budget = {str(m.device): inference.parse_memory_size(memory_budget, m.device) for m in (self.t2s, self.s2a)}
+            cfg = inference.fit_memory_budget(self.t2s, self.s2a, budget)
+            self.max_batch_size = max_batch_size = cfg['max_batch_size']
+            self.t2s.limit_context(cfg['t2s_stoks_len'])
+            self.s2a.limit_context(cfg['s2a_ctx_n'])
+        if optimize:
+            for model in (self.t2s, self.s2a):
+                model.optimize(max_batch_size=max_batch_size, torch_compile=torch_compile)
+
+        self.vocoder = vocoder or Vocoder(device=vocoder_device)
         self.encoder = None
 
     def extract_spk_emb(self, fname):
@@ -86,29 +123,161 @@ class Pipeline:
             self.encoder = EncoderClassifier.from_hparams("speechbrain/spkrec-ecapa-voxceleb",
                                                           savedir=expanduser("~/.cache/speechbrain/"),
                                                           run_opts={"device": device})
-        audio_info = torchaudio.info(fname)
-        actual_sample_rate = audio_info.sample_rate
-        num_frames = actual_sample_rate * 30 # specify 30 seconds worth of frames
-        samples, sr = torchaudio.load(fname, num_frames=num_frames)
-        samples = samples[:, :num_frames]
-        samples = self.encoder.audio_normalizer(samples[0], sr)
-        spk_emb = self.encoder.encode_batch(samples.unsqueeze(0))
+        with telemetry.stage("io"):
+            audio_info = torchaudio.info(fname)
+            actual_sample_rate = audio_info.sample_rate
+            num_frames = actual_sample_rate * 30 # specify 30 seconds worth of frames
+            samples, sr = torchaudio.load(fname, num_frames=num_frames)
+        with telemetry.stage("speaker_embedding"):
+            samples = samples[:, :num_frames]
+            samples = self.encoder.audio_normalizer(samples[0], sr)
+            spk_emb = self.encoder.encode_batch(samples.unsqueeze(0))
         
         return spk_emb[0,0].to(self.device)
         
-    def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        if speaker is None: speaker = self.default_speaker
-        elif isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
-        text = text.replace("\n", " ")
-        stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
-        atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback)
-        return atoks
+    def request(self):
+        """Measures everything inside as a single request (if telemetry is enabled)."""
+        return self.telemetry.request() if self.telemetry else nullcontext()
+
+    def generate_atoks(self, text, speaker=None, lang='en', cps=15, step_callback=None, trim_silence=False):
+        with self.request():
+            if speaker is None: speaker = self.default_speaker
+            elif isinstance(speaker, (str, Path)): speaker = self.extract_spk_emb(speaker)
+            text = text.replace("\n", " ")
+            with telemetry.stage("t2s"):
+                stoks = self.t2s.generate(text, cps=cps, lang=lang, step=step_callback)[0]
+            with telemetry.stage("s2a"):
+                atoks = self.s2a.generate(stoks, speaker.unsqueeze(0), step=step_callback)
+            if trim_silence: atoks = inference.trim_silence(atoks)
+            telemetry.count("stoks", stoks.shape[-1])
+            telemetry.count("atoks", atoks.shape[-1])
+            telemetry.count("audio_seconds", atoks.shape[-1] / 75)
+            return atoks
         
+    def _speaker_embeddings(self):
+        # converts speakers (`None`, audio files or embeddings) into embeddings, extracting each file only once
+        cache = {}
+        def spk_emb(s):
+            if s is not None and not isinstance(s, (str, Path)): return s
+            if s not in cache: cache[s] = self.default_speaker if s is None else self.extract_spk_emb(s)
+            return cache[s]
+        return spk_emb
+
+    def _split_text(self, text):
+        # splits `text` into pieces that fit into the T2S text context, preferably at the sentence boundaries
+        self.t2s.ensure_tokenizer()
+        fits = lambda x: len(self.t2s.tokenizer.encode(x)) < self.t2s.ttoks_len
+        pieces = []
+        for sentence in re.split(r"(?<=[.!?])\s+", text):
+            if pieces and fits(pieces[-1] + " " + sentence): pieces[-1] += " " + sentence
+            elif fits(sentence): pieces.append(sentence)
+            else:
+                for word in sentence.split(" "):
+                    if pieces and fits(pieces[-1] + " " + word): pieces[-1] += " " + word
+                    else: pieces.append(word)
+        return pieces
+
+    def generate_many(self, texts, speaker=None, lang='en', cps=15, batch_size=None, trim_silence=False, vocode=False):
+        """Synthesizes a list of texts in batches and returns the acoustic tokens for each of them (in the input order).
+        With `vocode=True` every result is an `(atoks, audio)` tuple.
+
+        `speaker`, `lang` and `cps` can also be lists with one value per text. The texts are grouped by language and
+        sorted by length so the rows of each batch finish after a similar number of decoding steps. Texts that don't
+        fit into the T2S context are split into sentences and the results are concatenated."""
+        n = len(texts)
+        per_text = lambda x: x if isinstance(x, list) else [x] * n
+        speakers, langs, cpss = per_text(speaker), per_text(lang), per_text(cps)
+        spk_emb = self._speaker_embeddings()
+        batch_size = batch_size or self.max_batch_size
+        eot = self.t2s.stoks_codes + self.t2s.tunables.padding_token_offset
+
+        # (text index, piece of the text) pairs
+        pieces = [(i, p) for i,text in enumerate(texts) for p in self._split_text(text.replace("\n", " "))]
+        results = [None] * len(pieces)
+        order = sorted(range(len(pieces)), key=lambda k: (langs[pieces[k][0]], len(pieces[k][1])))
+        for lang, group in itertools.groupby(order, key=lambda k: langs[pieces[k][0]]):
+            group = list(group)
+            for b in range(0, len(group), batch_size):
+                idxs = group[b:b+batch_size]
+                with self.request():
+                    with telemetry.stage("t2s"):
+                        stoks = self.t2s.generate([pieces[k][1] for k in idxs], cps=[cpss[pieces[k][0]] for k in idxs],
+                                                  lang=lang, show_progress_bar=False)
+                    # everything after the end of each row becomes S2A padding
+                    is_eot = stoks == eot
+                    lengths = torch.where(is_eot.any(-1), is_eot.to(torch.int).argmax(-1), stoks.shape[-1])
+                    stoks = stoks[:,:lengths.max()]
+                    stoks = stoks.masked_fill(torch.arange(stoks.shape[-1], device=stoks.device) >= lengths[:,None], self.s2a.stoks_codes-1)
+                    speakers_ = torch.stack([spk_emb(speakers[pieces[k][0]]).to(self.device) for k in idxs])
+                    with telemetry.stage("s2a"):
+                        atoks = self.s2a.generate(stoks, speakers_, bs=len(idxs), show_progress_bar=False)
+                    is_end = atoks[:,0] >= self.s2a.codes
+                    alengths = torch.where(is_end.any(-1), is_end.to(torch.int).argmax(-1), atoks.shape[-1]).clamp(min=1)
+                    rows = [atoks[j:j+1,:,:l] for j,l in enumerate(alengths.tolist())]
+                    if trim_silence: rows = [inference.trim_silence(r) for r in rows]
+                    frames = sum(r.shape[-1] for r in rows)
+                    telemetry.count("stoks", lengths.sum().item())
+                    telemetry.count("atoks", frames)
+                    telemetry.count("audio_seconds", frames / 75)
+                    if vocode:
+                        # pad every row by repeating it's last frame so we can vocode the whole batch at once
+                        T = max(r.shape[-1] for r in rows)
+                        padded = torch.cat([torch.cat([r, r[...,-1:].expand(-1,-1,T-r.shape[-1])], -1) for r in rows])
+                        audio = self.vocoder.decode(padded)
+                        hop = audio.shape[-1] // T
+                        rows = [(r, a[None,:r.shape[-1]*hop]) for r,a in zip(rows, audio)]
+                    for k,r in zip(idxs, rows): results[k] = r
+        merged = [[] for _ in range(n)]
+        for (i,_),r in zip(pieces, results): merged[i].append(r)
+        if vocode: return [tuple(torch.cat(x, -1) for x in zip(*rs)) for rs in merged]
+        return [torch.cat(rs, -1) for rs in merged]
+
+    def generate_pipelined(self, texts, speaker=None, lang='en', cps=15, trim_silence=False, vocode=True, depth=2):
+        """Yields the audio (or the acoustic tokens with `vocode=False`) for each of the `texts` in order.
+
+        T2S, S2A and the vocoder run in separate threads connected by queues (holding at most `depth` items), so
+        with the models on different devices (`t2s_device`, `s2a_device` and `vocoder_device`) three texts are
+        processed at the same time."""
+        n = len(texts)
+        per_text = lambda x: x if isinstance(x, list) else [x] * n
+        spk_emb = self._speaker_embeddings()
+        def t2s(job):
+            text, speaker, lang, cps = job
+            return self.t2s.generate(text.replace("\n", " "), cps=cps, lang=lang, show_progress_bar=False)[0], speaker
+        def s2a(job):
+            stoks, speaker = job
+            atoks = self.s2a.generate(stoks, spk_emb(speaker).unsqueeze(0), show_progress_bar=False)
+            return inference.trim_silence(atoks) if trim_silence else atoks
+        stages = [t2s, s2a] + ([self.vocoder.decode] if vocode else [])
+        queues = [queue.Queue()] + [queue.Queue(maxsize=depth) for _ in stages[1:]] + [queue.Queue()]
+        for job in zip(texts, per_text(speaker), per_text(lang), per_text(cps)): queues[0].put(job)
+        queues[0].put(None)
+        stop = threading.Event()
+        threads = [threading.Thread(target=_run_stage, args=(fun, inq, outq, stop), daemon=True)
+                   for fun, inq, outq in zip(stages, queues, queues[1:])]
+        for t in threads: t.start()
+        done = False
+        try:
+            for x in iter(queues[-1].get, None):
+                if isinstance(x, Exception): raise x
+                yield x
+            done = True
+        finally:
+            # the model calls that are already running use the shared KV caches so we have to wait for them before
+            # the next request, the stages skip the remaining jobs and we drain the output so no `put` stays blocked
+            stop.set()
+            if not done:
+                for _ in iter(queues[-1].get, None): pass
+            for t in threads: t.join()
+
     def generate(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        return self.vocoder.decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback))
+        with self.request():
+            return self.vocoder.decode(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=step_callback))
     
     def generate_to_file(self, fname, text, speaker=None, lang='en', cps=15, step_callback=None):
-        self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
+        with self.request():
+            self.vocoder.decode_to_file(fname, self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
         
     def generate_to_notebook(self, text, speaker=None, lang='en', cps=15, step_callback=None):
-        self.vocoder.decode_to_notebook(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
+        with self.request():
+            self.vocoder.decode_to_notebook(self.generate_atoks(text, speaker, lang=lang, cps=cps, step_callback=None))
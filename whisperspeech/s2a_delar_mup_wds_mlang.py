@@ -1,7 +1,7 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb.
 
 # %% auto 0
-__all__ = ['load_dataset', 'DelSumEmbedding', 'DelSumHead', 'rand', 'Tunables', 'SADelARTransformer']
+__all__ = ['load_dataset', 'DelSumEmbedding', 'DelSumHead', 'rand', 'Tunables', 'SADelARInference', 'SADelARTransformer']
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb 1
 import io
@@ -25,7 +25,7 @@ import json
 from fastprogress import progress_bar, master_bar
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb 4
-from . import inference
+from . import inference, sampling, telemetry
 from .modules import *
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb 8
@@ -137,8 +137,21 @@ class DelSumEmbedding(nn.Module):
         self.embeddings = nn.ModuleList(embs)
         if pos_embs is not None:
             self.register_buffer("positional_embedding", pos_embs)
+        self.fused = None
+
+    @torch.no_grad()
+    def convert_for_eval(self):
+        # one table with the (already merged) embeddings of all the quantizers stacked on top of each other
+        weight = torch.cat([emb.merged_in.weight for emb in self.embeddings])
+        self.fused = nn.Embedding(*weight.shape, _weight=weight)
+        self.fused_stride = self.embeddings[0].merged_in.num_embeddings
 
     def forward(self, toks, xenc):
+        if not self.training and self.fused is not None:
+            with record_function("embeddings"):
+                offsets = torch.arange(self.quantizers, device=toks.device)[:,None] * self.fused_stride
+                return self.fused(toks + offsets).sum(1).to(xenc.dtype)
+
         with record_function("embeddings"):
             b,_,n = toks.shape
             newn = min(n, self.length)
@@ -160,11 +173,26 @@ class DelSumHead(nn.Module):
             nn.Linear(self.width, self.width * quantizers),
             nn.GELU(),
         )
+        self.register_buffer('fused_out', None)
+        self.register_buffer('fused_bias', None)
+
+    @torch.no_grad()
+    def convert_for_eval(self, embeddings):
+        # all the unembedding matrices (and biases) in one tensor so we can use a single batched matmul
+        self.fused_out = torch.stack([emb.merged_out for emb in embeddings]).transpose(1,2).contiguous()
+        if embeddings[0].bias_out is not None:
+            self.fused_bias = torch.stack([emb.bias_out for emb in embeddings])[:,None]
 
     def forward(self, x, embeddings=None):
         b, newn, _ = x.shape
         with record_function("splitter"):
             split = self.splitter(x).view(b,newn,self.quantizers,self.width)
+        if not self.training and self.fused_out is not None:
+            with record_function("unembed"):
+                split = split.permute(2,0,1,3).reshape(self.quantizers, b*newn, self.width)
+                if self.fused_bias is None: logits = torch.bmm(split, self.fused_out)
+                else: logits = torch.baddbmm(self.fused_bias, split, self.fused_out)
+                return logits.view(self.quantizers, b, newn, -1).transpose(0,1)
         with record_function("unembed"):
             logits = torch.stack([embeddings[q].unembed(split[:,:,q]) for q in range(self.quantizers)], dim=1)
         return logits
@@ -185,6 +213,7 @@ class Tunables:
     rope :bool = True
     q0_loss_mult: float = 1
     causal_encoder :bool = False
+    kv_heads :int = None # grouped-query attention in the decoder (None uses n_head, 1 is multi-query attention)
     
     lr0 :float = 3e-3
     clip_gradient_norm :float = 2
@@ -229,7 +258,51 @@ class Tunables:
         old_default('force_hidden_to_emb', True)
         return args
             
-class SADelARTransformer(nn.Module):
+class SADelARInference:
+    "The inference helpers shared by the S2A models with (`s2a_delar_mup_wds_mlang_cond`) and without conditioning."
+    def limit_context(self, ctx_n):
+        "Shortens the maximum number of generated tokens (call it before `optimize` so the KV caches get smaller too)."
+        assert ctx_n <= self.__stored_args__['ctx_n'], "the context can't be longer than what the model was trained on"
+        self.ctx_n = ctx_n
+
+    def kv_cache_bytes(self, max_batch_size=1, dtype=torch.float16, ctx_n=None):
+        return inference.kv_cache_bytes(self.decoder, max_batch_size, ctx_n or self.ctx_n, self.stoks_len, dtype)
+
+    @torch.no_grad()
+    def generate_streaming(self, stoks, speakers, langs=None, atoks_prompt=None, window=None, context=250, lookahead=50, **kwargs):
+        """Generates the acoustic tokens for arbitrarily long `stoks` (of a single sample) in overlapping windows and
+        yields them chunk by chunk.
+
+        Every window runs the encoder on at most `window` semantic tokens and prefills the acoustic tokens generated
+        for the first `context` of them as a prompt, so the voice and prosody carry over without seams. The last
+        `lookahead` semantic tokens of a window only provide the right context and get generated again in the next one.
+        The KV caches and the encoder output never grow beyond a single window so memory use stays constant."""
+        window = window or min(self.stoks_len - 1, self.ctx_n // 3 - 2)
+        assert context + lookahead < window, "the window has to be longer than context + lookahead"
+        # the delayed quantizers make the output of `generate` a few frames shorter than 3 * the semantic tokens
+        assert lookahead >= 2, "the lookahead has to cover the quantizer delay"
+        kwargs.setdefault('show_progress_bar', False) # one bar per window would be confusing
+        stoks = stoks.reshape(-1)
+        s0, prompt = 0, atoks_prompt
+        start = 0 if prompt is None else prompt.shape[-1] # the first acoustic token (in this window) we did not yield yet
+        while True:
+            s1 = min(s0 + window, len(stoks))
+            last = s1 == len(stoks)
+            out = self.generate(stoks[s0:s1], speakers, langs, atoks_prompt=prompt, N=3*(s1-s0), cut_at_end=False, **kwargs)
+            # the model may end the utterance before the end of the window
+            is_end = (out[:,0] >= self.codes).any(0)
+            ended = bool(is_end.any())
+            if ended: out = out[..., :is_end.to(torch.int).argmax()]
+            end = out.shape[-1] if last or ended else 3*(s1-lookahead-s0)
+            if end > start: yield out[..., start:end]
+            if last or ended: return
+            # the next window starts `context` semantic tokens before the first acoustic token we did not yield
+            shift = s1 - lookahead - context - s0
+            s0 += shift
+            prompt = out[..., 3*shift:end]
+            start = prompt.shape[-1]
+
+class SADelARTransformer(SADelARInference, nn.Module):
     def __init__(self, depth=3, ctx_n=2250,
                  stoks_len=750, stoks_codes=4097, stoks_width=None,
                  spk_width=None,
@@ -278,10 +351,10 @@ class SADelARTransformer(nn.Module):
             n_head=n_head, head_width=head_width, atoks_width=atoks_width,
             quantizers=quantizers,
         )
-        self.decoder = BaseDecoder(qk_scale=qk_scale, length=ctx_n,
+        self.decoder = BaseDecoder(qk_scale=qk_scale,
                                      n_head=n_head, width=n_head * head_width, 
                                      ffn_mult=ffn_mult, depth=decoder_depth,
-                                     rope=tunables.rope)
+                                     rope=tunables.rope, n_kv_head=tunables.kv_heads)
         self.head = DelSumHead(n_head=n_head, head_width=head_width, quantizers=quantizers)
         for l in self.decoder.layers:
             l.cross_attn.key_subsampling = 3
@@ -462,6 +535,8 @@ class SADelARTransformer(nn.Module):
     def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
         for emb in self.embds.embeddings:
             emb.convert_for_eval()
+        self.embds.convert_for_eval()
+        self.head.convert_for_eval(self.embds.embeddings)
         for l in self.encoder:
             l.attn.convert_for_eval()
         for l in self.decoder.layers:
@@ -480,56 +555,106 @@ class SADelARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k, **sampling_kws):
         probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
         probs = probs[:,:,-1]
-        return inference.sample(probs, T, top_k)
+        return sampling.sample(probs, T, top_k, offset=positions[-1], **sampling_kws)
 
     def generate_next(self, *args, **kwargs):
         return self.generate_one(*args, **kwargs)
     
     @torch.no_grad()
-    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False):
+    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, top_p=None, min_p=None,
+                 repetition_penalty=None, seed=None, stop_check_every=8, show_progress_bar=True, step=None, subsample_enc=False,
+                 prompt_state=None, cut_at_end=True):
+        """Generates the acoustic tokens for `stoks`.
+
+        We stop early once every row emitted the end of audio, this is checked every `stop_check_every` steps since
+        each check is a host sync (1 checks after every step, `None` or 0 disables it and we always generate `N` steps).
+        With `cut_at_end` the output ends where the longest row emitted the end of audio, the shorter rows keep their
+        padding (pass each row to `inference.trim_silence` to trim it), otherwise we return all the generated frames."""
         dev = self.device
-        N = N or len(stoks) * 3
-        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
+        # `stoks` can also be a batch (one row per sample, padded with `stoks_codes-1`) with matching `speakers`
+        if stoks.dim() == 1: stoks = stoks.unsqueeze(0)
+        if len(stoks) > 1: bs = len(stoks)
+        N = N or stoks.shape[-1] * 3
+        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - stoks.shape[-1] - 1), value=self.stoks_codes-1)
         speakers = speakers.to(device=dev, dtype=self.dtype)
         toks = torch.full((bs,self.quantizers,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
-        T = torch.tensor(T, device=dev)
+        # scalars are shared by the whole batch, lists give per-row settings
+        T, top_p, min_p, repetition_penalty = [sampling.row_param(x, dev) for x in (T, top_p, min_p, repetition_penalty)]
+        if isinstance(top_k, (list, torch.Tensor)): top_k = sampling.row_param(top_k, dev, dtype=torch.long)
 
         start = 0 # number of valid tokens or the index of first empty spot
+        if prompt_state is not None: atoks_prompt = inference.prompt_toks(prompt_state)
         if atoks_prompt is not None:
             start = atoks_prompt.shape[-1]
             for i in range(self.quantizers):
                 toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
         start += 1 # we always start with at least an SOT
 
-        with record_function("encode"):
-            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
+        sampling_kws = dict(top_p=top_p, min_p=min_p)
+        if repetition_penalty is not None:
+            seen = torch.zeros((bs,self.quantizers,self.codes+2), dtype=torch.bool, device=dev) # +2 for the special tokens
+            if atoks_prompt is not None: seen.scatter_(-1, atoks_prompt.to(dev, torch.long).expand(bs,-1,-1), True)
+            sampling_kws.update(repetition_penalty=repetition_penalty, seen=seen)
+        if seed is not None: sampling_kws.update(seeds=sampling.row_seeds(seed, bs, dev))
+
+        with telemetry.stage("encode"):
+            stoks, speakers = [x.expand(bs, -1) for x in (stoks, speakers)]
             xenc, xenc_positions, _ = self.run_encoder(stoks, speakers)
             toks_positions = torch.arange(N, device=dev)
-        with record_function("prefill"):
-            initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k)
+        with telemetry.stage("prefill"):
+            # with a cached prompt we only have to run the last prompt token
+            p = inference.restore_prompt_states(self.decoder, prompt_state, bs) if prompt_state is not None else 0
+            initial = self.generate_one(toks[:,:,p:start], toks_positions[p:start], langs, xenc, xenc_positions, T, top_k, **sampling_kws)
             toks[:,:start,start:start+1] = initial[:,:start]
+            if repetition_penalty is not None: sampling.mark_seen(seen[:,:start], initial[:,:start])
             start += 1
             
-        with inference.inference_context():
+        with inference.inference_context(), telemetry.stage("decode"):
             it = range(start,min(N,self.ctx_n-1))
             if show_progress_bar: it = progress_bar(it)
 
+            # rows that already emitted the end-of-audio padding, kept on the device and only checked
+            # every `stop_check_every` steps to avoid a host sync on every token
+            ended = torch.zeros(bs, dtype=torch.bool, device=dev)
+            stop_at = None
             for i in it:
                 with record_function("generate_one"):
-                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k)[:,:i]
+                    new = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k, **sampling_kws)
+                    toks[:,:i,i:i+1] = new[:,:i]
+                    if repetition_penalty is not None: sampling.mark_seen(seen[:,:i], new[:,:i])
+                    ended |= new[:,0,0] == self.codes
 
                 # for profiling, debugging or early exit
                 if step is not None: step()
+
+                if stop_at is None and stop_check_every and i % stop_check_every == 0 and ended.all():
+                    stop_at = i + self.quantizers # let the delayed quantizers finish the last frame
+                if i == stop_at:
+                    N = i + 1
+                    break
         # shift tokens
         toks = toks[:,:,1:N]
         for j in range(self.quantizers):
             toks[:, j] = torch.roll(toks[:, j], -j)
-        return toks[:,:,:N-4]
+        toks = toks[:,:,:N-4]
+        if not cut_at_end: return toks
+        # cut off the padding after the end of the longest row
+        is_end = toks[:,0] >= self.codes
+        lengths = torch.where(is_end.any(-1), is_end.to(torch.int).argmax(-1), toks.shape[-1])
+        return toks[:,:,:lengths.max()]
 
-# %% ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb 15
+    @torch.no_grad()
+    def prompt_state(self, atoks_prompt, stoks, speakers, langs=None):
+        """Prefills the `atoks_prompt` once (with the `stoks` and `speakers` as the encoder context) and returns an
+        `inference.PromptState` that can be reused by many `generate(prompt_state=...)` calls."""
+        atoks_prompt = atoks_prompt.to(self.device).reshape(1, self.quantizers, -1)
+        self.generate(stoks, speakers, langs, atoks_prompt=atoks_prompt, N=atoks_prompt.shape[-1]+2, show_progress_bar=False)
+        return inference.PromptState.capture(self.decoder, atoks_prompt, atoks_prompt.shape[-1])
+
+# %% ../nbs/4B. Multi-language semantic to acoustic token modeling.ipynb 16
 def _make_model(size:str, quantizers:int=4, tunables:Tunables=Tunables(), **kwargs):
     kwargs = dict(quantizers=quantizers, tunables=tunables, **kwargs)
     if size == 'micro':
@@ -1,8 +1,8 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb.
 
 # %% auto 0
-__all__ = ['load_dataset', 'DelSumEmbedding', 'DelSumHead', 'rand', 'Tunables', 'CategoricalEmbedding', 'BinnedEmbedding',
-           'SpeakerEmbedding', 'SADelARTransformer']
+__all__ = ['load_dataset', 'rand', 'Tunables', 'collate_conds', 'CategoricalEmbedding', 'BinnedEmbedding', 'SpeakerEmbedding',
+           'SADelARTransformer']
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 1
 import io
@@ -26,7 +26,7 @@ import json
 from fastprogress import progress_bar, master_bar
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 4
-from . import inference, languages
+from . import inference, sampling, telemetry, languages
 from .modules import *
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 8
@@ -139,6 +139,7 @@ def load_dataset(
         wds.shuffle(20000, initial=20000),
         wds.batched(64),
         wds.map_tuple(None, None, randomize_conditionings),
+        wds.map_tuple(None, None, collate_conds),
     )
     if validation:
         ds = ds.slice(samples // 64)
@@ -148,56 +149,11 @@ def load_dataset(
     return ds
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 13
-class DelSumEmbedding(nn.Module):
-    def __init__(self, n_head=6, head_width=64, atoks_width=None, length=2250, codes=1024, quantizers=8, pos_embs=None):
-        super().__init__()
-        self.length = length
-        width = n_head * head_width
-        if atoks_width is None: atoks_width = width
-        self.width = width
-        self.quantizers = quantizers
-
-        emb = None
-        embs = []
-        for _ in range(quantizers):
-            emb = FlexEmbeddings(codes, width, special_codes=2, frozen_width=atoks_width,
-                                 special_embedding=emb and emb.special)
-            embs.append(emb)
-        self.embeddings = nn.ModuleList(embs)
-        if pos_embs is not None:
-            self.register_buffer("positional_embedding", pos_embs)
-
-    def forward(self, toks, xenc):
-        with record_function("embeddings"):
-            b,_,n = toks.shape
-            newn = min(n, self.length)
-
-            embs = torch.zeros((b,newn,self.width), dtype=xenc.dtype, device=xenc.device)
-            for i in range(self.quantizers):
-                embs[:, :] += self.embeddings[i](toks[:,i,:])
-            
-            x = embs.to(xenc.dtype)
-        return x
+# the delayed-sum embeddings and heads (with their fused inference versions) and the inference helpers are shared
+# with the model without conditioning
+from .s2a_delar_mup_wds_mlang import DelSumEmbedding, DelSumHead, SADelARInference
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 14
-class DelSumHead(nn.Module):
-    def __init__(self, quantizers=8, n_head=6, head_width=64):
-        super().__init__()
-        self.width = n_head * head_width
-        self.quantizers = quantizers
-        self.splitter = nn.Sequential(
-            nn.Linear(self.width, self.width * quantizers),
-            nn.GELU(),
-        )
-
-    def forward(self, x, embeddings=None):
-        b, newn, _ = x.shape
-        with record_function("splitter"):
-            split = self.splitter(x).view(b,newn,self.quantizers,self.width)
-        with record_function("unembed"):
-            logits = torch.stack([embeddings[q].unembed(split[:,:,q]) for q in range(self.quantizers)], dim=1)
-        return logits
-        
 def rand(start, end):
     return random.random() * (end - start) + start
     
@@ -214,6 +170,7 @@ class Tunables:
     rope :bool = True
     q0_loss_mult: float = 1
     causal_encoder :bool = False
+    kv_heads :int = None # grouped-query attention in the decoder (None uses n_head, 1 is multi-query attention)
     
     lr0 :float = 3e-3
     clip_gradient_norm :float = 2
@@ -258,6 +215,19 @@ class Tunables:
         old_default('force_hidden_to_emb', True)
         return args
 
+def collate_conds(conds):
+    """Converts a list of per-sample conditioning dicts into a dict of batched float32 tensors.
+
+    Missing scalar conditionings become NaNs and missing vectors (speaker embeddings) are zeroed, which the
+    embeddings below treat as unknown. Conditionings missing from every sample are left out."""
+    out = {}
+    for k in dict.fromkeys(k for x in conds for k in x):
+        vals = [torch.as_tensor(x[k], dtype=torch.float32) if k in x else None for x in conds]
+        present = next(v for v in vals if v is not None)
+        default = torch.zeros_like(present) if present.dim() else torch.tensor(torch.nan)
+        out[k] = torch.stack([default if v is None else v for v in vals])
+    return out
+
 class CategoricalEmbedding(nn.Module):
     default = torch.nan
 
@@ -267,7 +237,7 @@ class CategoricalEmbedding(nn.Module):
         self.embed = nn.Embedding(codes+1, width)
         
     def forward(self, x):
-        x[torch.isnan(x)] = self.codes # separate code for NaNs which represent missing conditioning
+        x = torch.where(torch.isnan(x), self.codes, x) # separate code for NaNs which represent missing conditioning
         return self.embed(x.to(torch.long))
 
 
@@ -281,10 +251,9 @@ class BinnedEmbedding(nn.Module):
         
     def forward(self, x):
         # calculate the bin index
-        qx = ((x - self.vmin) / (self.vmax - self.vmin) * self.bins).to(torch.long)
-        qx.clamp_(0,self.bins-1)
-        qx[torch.isnan(x)] = self.bins # separate bin for NaNs which represent missing conditioning
-        return self.embed(qx.to(torch.long))
+        qx = ((x - self.vmin) / (self.vmax - self.vmin) * self.bins).to(torch.long).clamp(0,self.bins-1)
+        qx = torch.where(torch.isnan(x), self.bins, qx) # separate bin for NaNs which represent missing conditioning
+        return self.embed(qx)
     
 class SpeakerEmbedding(nn.Module):
     def __init__(self, spk_width, width):
@@ -298,10 +267,8 @@ class SpeakerEmbedding(nn.Module):
         x = F.normalize(x, dim=-1)
         if self.spk_to_hidden: x = self.spk_to_hidden(x.to(self.spk_to_hidden.weight.dtype))
         return x
-    
-from webdataset.filters import default_collation_fn
         
-class SADelARTransformer(nn.Module):
+class SADelARTransformer(SADelARInference, nn.Module):
     def __init__(self, depth=3, ctx_n=2250,
                  stoks_len=750, stoks_codes=4097, stoks_width=None,
                  spk_width=None,
@@ -353,10 +320,10 @@ class SADelARTransformer(nn.Module):
             n_head=n_head, head_width=head_width, atoks_width=atoks_width,
             quantizers=quantizers,
         )
-        self.decoder = BaseDecoder(qk_scale=qk_scale, length=ctx_n,
+        self.decoder = BaseDecoder(qk_scale=qk_scale,
                                      n_head=n_head, width=n_head * head_width, 
                                      ffn_mult=ffn_mult, depth=decoder_depth,
-                                     rope=tunables.rope)
+                                     rope=tunables.rope, n_kv_head=tunables.kv_heads)
         self.head = DelSumHead(n_head=n_head, head_width=head_width, quantizers=quantizers)
         for l in self.decoder.layers:
             l.cross_attn.key_subsampling = 3
@@ -436,14 +403,15 @@ class SADelARTransformer(nn.Module):
         else:
             enc_logits = None
 
+        # `conds` is a list of per-sample dicts or (faster) a dict of batched tensors from `collate_conds`
+        if not isinstance(conds, dict): conds = collate_conds(conds)
         cond_embs = torch.zeros((bs,semb.shape[-1]), dtype=semb.dtype, device=semb.device)
-        for k in self.cond_embeddings.keys():
-            samples = [(x.get(k, self.cond_embeddings[k].default),) for x in conds]
-            c = default_collation_fn(samples)[0]
-#             print(c.shape, type(c), getattr(c, 'device', None))
-            if isinstance(c, np.ndarray): c = torch.tensor(c, device=Stoks.device)
-            if isinstance(c, torch.Tensor): c = c.to(device=Stoks.device)
-            cond_embs += self.cond_embeddings[k](c)
+        for k, emb in self.cond_embeddings.items():
+            c = conds.get(k)
+            if c is None:
+                c = torch.as_tensor(emb.default)
+                c = c.expand(bs, *c.shape)
+            cond_embs += emb(c.to(Stoks.device))
         
         return xenc + cond_embs.unsqueeze(1), positions, enc_logits
 
@@ -537,6 +505,8 @@ class SADelARTransformer(nn.Module):
     def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
         for emb in self.embds.embeddings:
             emb.convert_for_eval()
+        self.embds.convert_for_eval()
+        self.head.convert_for_eval(self.embds.embeddings)
         for l in self.encoder:
             l.attn.convert_for_eval()
         for l in self.decoder.layers:
@@ -555,54 +525,105 @@ class SADelARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, positions, langs, xenc, xenc_positions, T, top_k, **sampling_kws):
         probs = self(None, toks, None, langs, noloss=True, xenc=xenc, xenc_positions=xenc_positions, atoks_positions=positions)
         probs = probs[:,:,-1]
-        return inference.sample(probs, T, top_k)
+        return sampling.sample(probs, T, top_k, offset=positions[-1], **sampling_kws)
 
     def generate_next(self, *args, **kwargs):
         return self.generate_one(*args, **kwargs)
     
     @torch.no_grad()
-    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, show_progress_bar=True, step=None, subsample_enc=False):
+    def generate(self, stoks, speakers, langs=None, atoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, top_p=None, min_p=None,
+                 repetition_penalty=None, seed=None, stop_check_every=8, show_progress_bar=True, step=None, subsample_enc=False,
+                 prompt_state=None, cut_at_end=True):
+        """Generates the acoustic tokens for `stoks`.
+
+        We stop early once every row emitted the end of audio, this is checked every `stop_check_every` steps since
+        each check is a host sync (1 checks after every step, `None` or 0 disables it and we always generate `N` steps).
+        With `cut_at_end` the output ends where the longest row emitted the end of audio, the shorter rows keep their
+        padding (pass each row to `inference.trim_silence` to trim it), otherwise we return all the generated frames."""
         dev = self.device
-        N = N or len(stoks) * 3
-        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - len(stoks) - 1), value=self.stoks_codes-1).unsqueeze(0)
+        # `stoks` can also be a batch (one row per sample, padded with `stoks_codes-1`) with matching `speakers`
+        if stoks.dim() == 1: stoks = stoks.unsqueeze(0)
+        if len(stoks) > 1: bs = len(stoks)
+        N = N or stoks.shape[-1] * 3
+        stoks = F.pad(stoks.to(dev), (1, self.stoks_len - stoks.shape[-1] - 1), value=self.stoks_codes-1)
         speakers = speakers.to(device=dev, dtype=self.dtype)
         toks = torch.full((bs,self.quantizers,self.ctx_n), self.codes+1, dtype=torch.long, device=dev)
-        T = torch.tensor(T, device=dev)
+        # scalars are shared by the whole batch, lists give per-row settings
+        T, top_p, min_p, repetition_penalty = [sampling.row_param(x, dev) for x in (T, top_p, min_p, repetition_penalty)]
+        if isinstance(top_k, (list, torch.Tensor)): top_k = sampling.row_param(top_k, dev, dtype=torch.long)
 
         start = 0 # number of valid tokens or the index of first empty spot
+        if prompt_state is not None: atoks_prompt = inference.prompt_toks(prompt_state)
         if atoks_prompt is not None:
             start = atoks_prompt.shape[-1]
             for i in range(self.quantizers):
                 toks[:,i,1+i:start+i+1] = atoks_prompt[:,i]
         start += 1 # we always start with at least an SOT
 
-        with record_function("encode"):
-            stoks, speakers = [x.repeat(bs, 1) for x in (stoks, speakers)]
-            xenc, xenc_positions, _ = self.run_encoder(stoks, [dict(speaker = s, snr=60, c50=60) for s in speakers])
+        sampling_kws = dict(top_p=top_p, min_p=min_p)
+        if repetition_penalty is not None:
+            seen = torch.zeros((bs,self.quantizers,self.codes+2), dtype=torch.bool, device=dev) # +2 for the special tokens
+            if atoks_prompt is not None: seen.scatter_(-1, atoks_prompt.to(dev, torch.long).expand(bs,-1,-1), True)
+            sampling_kws.update(repetition_penalty=repetition_penalty, seen=seen)
+        if seed is not None: sampling_kws.update(seeds=sampling.row_seeds(seed, bs, dev))
+
+        with telemetry.stage("encode"):
+            stoks, speakers = [x.expand(bs, -1) for x in (stoks, speakers)]
+            conds = dict(speaker=speakers, snr=torch.full((bs,), 60., device=dev), c50=torch.full((bs,), 60., device=dev))
+            xenc, xenc_positions, _ = self.run_encoder(stoks, conds)
             toks_positions = torch.arange(N, device=dev)
-        with record_function("prefill"):
-            initial = self.generate_one(toks[:,:,:start], toks_positions[:start], langs, xenc, xenc_positions, T, top_k)
+        with telemetry.stage("prefill"):
+            # with a cached prompt we only have to run the last prompt token
+            p = inference.restore_prompt_states(self.decoder, prompt_state, bs) if prompt_state is not None else 0
+            initial = self.generate_one(toks[:,:,p:start], toks_positions[p:start], langs, xenc, xenc_positions, T, top_k, **sampling_kws)
             toks[:,:start,start:start+1] = initial[:,:start]
+            if repetition_penalty is not None: sampling.mark_seen(seen[:,:start], initial[:,:start])
             start += 1
             
-        with inference.inference_context():
+        with inference.inference_context(), telemetry.stage("decode"):
             it = range(start,min(N,self.ctx_n-1))
             if show_progress_bar: it = progress_bar(it)
 
+            # rows that already emitted the end-of-audio padding, kept on the device and only checked
+            # every `stop_check_every` steps to avoid a host sync on every token
+            ended = torch.zeros(bs, dtype=torch.bool, device=dev)
+            stop_at = None
             for i in it:
                 with record_function("generate_one"):
-                    toks[:,:i,i:i+1] = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k)[:,:i]
+                    new = self.generate_next(toks[:,:,i-1:i], toks_positions[i-1:i], langs, xenc, xenc_positions, T, top_k, **sampling_kws)
+                    toks[:,:i,i:i+1] = new[:,:i]
+                    if repetition_penalty is not None: sampling.mark_seen(seen[:,:i], new[:,:i])
+                    ended |= new[:,0,0] == self.codes
 
                 # for profiling, debugging or early exit
                 if step is not None: step()
+
+                if stop_at is None and stop_check_every and i % stop_check_every == 0 and ended.all():
+                    stop_at = i + self.quantizers # let the delayed quantizers finish the last frame
+                if i == stop_at:
+                    N = i + 1
+                    break
         # shift tokens
         toks = toks[:,:,1:N]
         for j in range(self.quantizers):
             toks[:, j] = torch.roll(toks[:, j], -j)
-        return toks[:,:,:N-4]
+        toks = toks[:,:,:N-4]
+        if not cut_at_end: return toks
+        # cut off the padding after the end of the longest row
+        is_end = toks[:,0] >= self.codes
+        lengths = torch.where(is_end.any(-1), is_end.to(torch.int).argmax(-1), toks.shape[-1])
+        return toks[:,:,:lengths.max()]
+
+    @torch.no_grad()
+    def prompt_state(self, atoks_prompt, stoks, speakers, langs=None):
+        """Prefills the `atoks_prompt` once (with the `stoks` and `speakers` as the encoder context) and returns an
+        `inference.PromptState` that can be reused by many `generate(prompt_state=...)` calls."""
+        atoks_prompt = atoks_prompt.to(self.device).reshape(1, self.quantizers, -1)
+        self.generate(stoks, speakers, langs, atoks_prompt=atoks_prompt, N=atoks_prompt.shape[-1]+2, show_progress_bar=False)
+        return inference.PromptState.capture(self.decoder, atoks_prompt, atoks_prompt.shape[-1])
 
 # %% ../nbs/4B. Multi-language semantic to acoustic token modeling-Copy2.ipynb 15
 def _make_model(size:str, quantizers:int=4, tunables:Tunables=Tunables(), **kwargs):
@@ -0,0 +1,106 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Sampling.ipynb.
+
+# %% auto 0
+__all__ = ['row_param', 'multinomial_sample_one_no_sync', 'apply_repetition_penalty', 'mark_seen', 'row_seeds',
+           'seeded_exponential_like', 'logits_to_probs', 'sample']
+
+# %% ../nbs/D. Sampling.ipynb 3
+import math
+import torch
+
+# %% ../nbs/D. Sampling.ipynb 4
+def row_param(x, device, dtype=torch.float32):
+    """Converts a sampling parameter (a scalar or a list with one value per row) into a tensor."""
+    if x is None: return None
+    if isinstance(x, torch.Tensor): return x.to(device=device, dtype=dtype)
+    return torch.tensor(x, device=device, dtype=dtype)
+
+def _per_row(x, logits):
+    # reshape a `(bs,)` parameter so it broadcasts over `logits` of shape `(bs, ..., vocab)`
+    if isinstance(x, torch.Tensor): return x.reshape(-1, *[1]*(logits.dim()-1))
+    return x
+
+# %% ../nbs/D. Sampling.ipynb 5
+# from https://github.com/pytorch-labs/gpt-fast/blob/main/generate.py
+def multinomial_sample_one_no_sync(probs_sort, q=None): # Does multinomial sampling without a cuda synchronization
+    if q is None: q = torch.empty_like(probs_sort).exponential_(1)
+    return torch.argmax(probs_sort / q, dim=-1, keepdim=True).to(dtype=torch.int)
+
+def apply_repetition_penalty(logits, seen, penalty):
+    """Penalizes the logits of tokens already marked in the boolean `seen` mask (CTRL-style)."""
+    penalty = _per_row(penalty, logits)
+    penalized = torch.where(logits > 0, logits / penalty, logits * penalty)
+    return torch.where(seen, penalized, logits)
+
+def mark_seen(seen, toks, inplace=True):
+    """Marks the freshly sampled `toks` (with the trailing dimension of 1 returned by `sample`) in `seen`.
+
+    Use `inplace=False` inside compiled functions, mutating an input tensor there breaks the CUDA graphs."""
+    if inplace: return seen.scatter_(-1, toks.to(torch.long), True)
+    return seen.scatter(-1, toks.to(torch.long), True)
+
+# %% ../nbs/D. Sampling.ipynb 7
+def row_seeds(seed, bs, device):
+    """Converts a seed into a `(bs,)` tensor of per-row seeds. An `int` seeds the rows with `seed, seed+1, ...`."""
+    if isinstance(seed, int): return torch.arange(seed, seed+bs, device=device)
+    return row_param(seed, device, dtype=torch.long)
+
+def _hash32(x):
+    # the "lowbias32" integer hash (https://nullprogram.com/blog/2018/07/31/) done in int64 with explicit wrapping
+    x = x & 0xffffffff
+    x = x ^ (x >> 16)
+    x = (x * 0x7feb352d) & 0xffffffff
+    x = x ^ (x >> 15)
+    x = (x * 0x846ca68b) & 0xffffffff
+    return x ^ (x >> 16)
+
+def seeded_exponential_like(probs, seeds, offset):
+    """Exp(1) noise for `multinomial_sample_one_no_sync` that only depends on the row `seeds`, the `offset` and the
+    position inside each row."""
+    idx = torch.arange(probs[0].numel(), device=probs.device).view(probs.shape[1:])
+    key = _hash32(_hash32(_per_row(seeds, probs)) + offset)
+    u = ((_hash32(_hash32(idx) ^ key) >> 8).to(torch.float32) + 0.5) / 2**24 # 24 bits fit exactly into a float32
+    return -torch.log(u)
+
+# %% ../nbs/D. Sampling.ipynb 8
+def logits_to_probs(logits, T=1.0, top_k=None, top_p=None, min_p=None):
+    if isinstance(T, torch.Tensor): logits = logits / _per_row(T, logits).clamp(min=1e-5)
+    else: logits = logits / max(T, 1e-5)
+
+    if min_p is not None:
+        # p < min_p * p_max  <=>  logit < logit_max + log(min_p)
+        if isinstance(min_p, torch.Tensor): log_min_p = _per_row(min_p, logits).log()
+        else: log_min_p = math.log(min_p) if min_p > 0 else -math.inf
+        logits = logits.masked_fill(logits < logits.amax(-1, keepdim=True) + log_min_p, -float("Inf"))
+
+    if top_p is None and (top_k is None or isinstance(top_k, int)):
+        if top_k is not None:
+            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+            pivot = v.select(-1, -1).unsqueeze(-1)
+            logits = torch.where(logits < pivot, -float("Inf"), logits)
+    else:
+        # per-row top-k and top-p both work on the same sorted logits
+        sorted_logits, sorted_idx = logits.sort(dim=-1, descending=True)
+        ranks = torch.arange(logits.shape[-1], device=logits.device)
+        if top_k is not None:
+            if isinstance(top_k, torch.Tensor):
+                top_k = _per_row(top_k, logits)
+                top_k = torch.where(top_k > 0, top_k, logits.shape[-1]) # 0 disables top-k for that row
+            sorted_logits = sorted_logits.masked_fill(ranks >= top_k, -float("Inf"))
+        if top_p is not None:
+            sorted_probs = sorted_logits.softmax(dim=-1)
+            # we always keep the most probable token, even if it's probability exceeds top_p
+            cum_probs = sorted_probs.cumsum(dim=-1) - sorted_probs
+            sorted_logits = sorted_logits.masked_fill(cum_probs > _per_row(top_p, logits), -float("Inf"))
+        logits = torch.empty_like(logits).scatter_(-1, sorted_idx, sorted_logits)
+
+    probs = torch.nn.functional.softmax(logits, dim=-1)
+    return probs
+
+def sample(logits, T=1.0, top_k=None, top_p=None, min_p=None, repetition_penalty=None, seen=None, seeds=None, offset=0):
+    if repetition_penalty is not None and seen is not None:
+        logits = apply_repetition_penalty(logits, seen, repetition_penalty)
+    probs = logits_to_probs(logits, T, top_k, top_p, min_p)
+    q = seeded_exponential_like(probs, seeds, offset) if seeds is not None else None
+    idx_next = multinomial_sample_one_no_sync(probs, q)
+    return idx_next
@@ -0,0 +1,82 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Synthetic models.ipynb.
+
+# %% auto 0
+__all__ = ['t2s_config', 's2a_config', 'vq_shape', 'make_vq', 'make_t2s', 'make_s2a', 'StubVocoder', 'make_pipeline']
+
+# %% ../nbs/D. Synthetic models.ipynb 3
+import re
+from types import SimpleNamespace
+
+import torch
+
+from whisperspeech import telemetry, t2s_up_wds_mlang_enclm, s2a_delar_mup_wds_mlang, s2a_delar_mup_wds_mlang_cond
+
+# %% ../nbs/D. Synthetic models.ipynb 4
+# the context lengths of the released models (30 seconds of audio)
+t2s_config = dict(ttoks_len=550, stoks_len=750)
+s2a_config = dict(ctx_n=2250, stoks_len=750, spk_width=192)
+
+def vq_shape(vq_size):
+    "The number of semantic token codes and the codebook width for a `vq_stoks.make_model` preset name."
+    codes = int(re.search(r'-(\d+)c', vq_size).group(1))
+    dim = re.search(r'-dim(\d+)', vq_size)
+    return codes, int(dim.group(1)) if dim else 32
+
+def make_vq(size='base-2d-512c-dim64', device='cpu'):
+    "A random `RQBottleneckTransformer` (the Whisper model itself is only loaded when needed)."
+    from whisperspeech import vq_stoks
+    return vq_stoks.make_model(size).to(device).eval()
+
+def make_t2s(size='tiny', vq_size='base-2d-512c-dim64', tunables=t2s_up_wds_mlang_enclm.Tunables(), device='cpu', **kwargs):
+    codes, dim = vq_shape(vq_size)
+    dataset = SimpleNamespace(stoks_codes=codes+1, **t2s_config)
+    model = t2s_up_wds_mlang_enclm._make_model(size, tunables, dataset, stoks_width=dim, **kwargs)
+    return model.to(device).eval()
+
+def make_s2a(size='tiny', quantizers=4, vq_size='base-2d-512c-dim64', conditioning=False, device='cpu', **kwargs):
+    module = s2a_delar_mup_wds_mlang_cond if conditioning else s2a_delar_mup_wds_mlang
+    codes, dim = vq_shape(vq_size)
+    kwargs = dict(s2a_config, **kwargs)
+    model = module._make_model(size, quantizers, module.Tunables(), stoks_codes=codes+1, stoks_width=dim, **kwargs)
+    return model.to(device).eval()
+
+# %% ../nbs/D. Synthetic models.ipynb 5
+class StubVocoder:
+    """A drop-in replacement for `a2wav.Vocoder` that turns acoustic tokens into noise with a table lookup.
+
+    It does not need the Vocos weights but it is also much faster, so it is only useful to benchmark the other stages."""
+    def __init__(self, quantizers=8, codes=1024, hop_length=320, device='cpu'):
+        self.device = device
+        g = torch.Generator().manual_seed(0)
+        self.frames = (torch.randn(quantizers, codes, hop_length, generator=g) * .01).to(device)
+
+    @torch.no_grad()
+    @telemetry.stage("vocoder")
+    def decode(self, atoks):
+        if len(atoks.shape) == 2: atoks = atoks.unsqueeze(0)
+        atoks = atoks.to(self.device).clamp(max=self.frames.shape[1]-1)
+        b,q,t = atoks.shape
+        audio = torch.stack([self.frames[i][atoks[:,i]] for i in range(q)]).sum(0)
+        return audio.reshape(b, t * self.frames.shape[-1])
+
+    def decode_to_file(self, fname, atoks):
+        import torchaudio
+        audio = self.decode(atoks)
+        with telemetry.stage("io"):
+            torchaudio.save(fname, audio.cpu(), 24000)
+
+    def decode_to_notebook(self, atoks):
+        from IPython.display import display, Audio
+        display(Audio(self.decode(atoks).cpu().numpy(), rate=24000))
+
+# %% ../nbs/D. Synthetic models.ipynb 6
+def make_pipeline(t2s_size='tiny', s2a_size='tiny', vq_size='base-2d-512c-dim64', device=None, max_stoks=None, **kwargs):
+    """A `Pipeline` built from random models and the `StubVocoder`. Random models never emit the end-of-text token,
+    `max_stoks` limits the T2S output length to keep tests fast."""
+    from whisperspeech.pipeline import Pipeline
+    from whisperspeech.inference import get_compute_device
+    device = device or get_compute_device()
+    t2s = make_t2s(t2s_size, vq_size, device=device)
+    if max_stoks: t2s.stoks_len = max_stoks
+    return Pipeline(t2s=t2s, s2a=make_s2a(s2a_size, vq_size=vq_size, device=device),
+                    vocoder=StubVocoder(device=device), device=device, **kwargs)
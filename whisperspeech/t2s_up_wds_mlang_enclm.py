@@ -21,7 +21,7 @@ from pathlib import Path
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 2
 from whisperspeech.modules import *
-from whisperspeech import languages, inference
+from whisperspeech import languages, inference, sampling, telemetry
 
 # %% ../nbs/5B. Multi-lang text to semantic token modeling.ipynb 6
 import re
@@ -155,6 +155,7 @@ class Tunables:
     cps_input: bool = True
     cps_bins: int = 32
     padding_token_offset: int = 0
+    kv_heads: int = None # grouped-query attention in the decoder (None uses n_head, 1 is multi-query attention)
         
     lr0 :float = 1.5e-3
     clip_gradient_norm :float = .2
@@ -218,9 +219,6 @@ class Encoder(nn.Module):
 
         self.ln_post = LayerNorm(width)
         
-        mask = torch.empty(length, length).fill_(-torch.inf).triu_(1)
-        self.register_buffer("mask", mask, persistent=False)
-        
     def forward(self, Stoks, positions, lang_emb=None):
         xin = self.embedding(Stoks)
 
@@ -229,9 +227,7 @@ class Encoder(nn.Module):
         x = (xin +
              self.positional_embedding[positions]).to(xin.dtype)
 
-        for l in self.layers: x = l(x, positions,
-                                    causal=self.tunables.causal_encoder and self.training,
-                                    mask=self.mask if self.tunables.causal_encoder and not self.training else None)
+        for l in self.layers: x = l(x, positions, causal=self.tunables.causal_encoder)
         
         return self.ln_post(x)
 
@@ -264,10 +260,10 @@ class TSARTransformer(nn.Module):
         self.embeddings = T2SEmbedding(length=stoks_len, codes=stoks_codes, width=width, stoks_width=self.stoks_width)
 
         self.decoder = BaseDecoder(
-            length=stoks_len, 
             depth=decoder_depth,
             qk_scale=tunables.query_mult*8/math.sqrt(width/n_head),
             width=width, n_head=n_head, ffn_mult=ffn_mult,
+            n_kv_head=tunables.kv_heads,
         )
         self.tokenizer = None
         
@@ -398,6 +394,14 @@ class TSARTransformer(nn.Module):
             for bn,b in m.named_buffers(recurse=False):
                 setattr(m,bn,b.to(dtype))
 
+    def limit_context(self, stoks_len):
+        "Shortens the maximum number of generated tokens (call it before `optimize` so the KV caches get smaller too)."
+        assert stoks_len <= self.__stored_args__['stoks_len'], "the context can't be longer than what the model was trained on"
+        self.stoks_len = stoks_len
+
+    def kv_cache_bytes(self, max_batch_size=1, dtype=torch.float16, stoks_len=None):
+        return inference.kv_cache_bytes(self.decoder, max_batch_size, stoks_len or self.stoks_len, self.ttoks_len, dtype)
+
     def optimize(self, max_batch_size=1, dtype=torch.float16, torch_compile=True):
         for emb in [self.embeddings.embedding, self.embeddings.embedding]:
             emb.convert_for_eval()
@@ -410,6 +414,7 @@ class TSARTransformer(nn.Module):
         self.switch_dtypes(dtype)
         if torch_compile:
             self.generate_next = torch.compile(self.generate_next, mode="reduce-overhead", fullgraph=True)
+            self.generate_next_steps = torch.compile(self.generate_next_steps, mode="reduce-overhead", fullgraph=True)
             
     def optimize_training(self):
         # breaks with: Error: accessing tensor output of CUDAGraphs that has been overwritten by a subsequent run.
@@ -421,15 +426,29 @@ class TSARTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k):
+    def generate_one(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws):
         probs, _ = self(None, None, None, None, toks, in_stoks_positions=toks_positions, loss=None, xenc=xenc, xenc_positions=xenc_positions, cps_emb=cps_emb)
         probs = probs[:,-1]
         probs[self.embeddings.embedding.codes:] = -torch.inf
-        return inference.sample(probs, T, top_k)
+        return sampling.sample(probs, T, top_k, offset=toks_positions[-1], **sampling_kws)
 
     def generate_next(self, *args, **kwargs):
         return self.generate_one(*args, **kwargs)
 
+    def generate_steps(self, toks, toks_positions, cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws):
+        # runs one decoding step for every position feeding back the sampled tokens,
+        # when compiled all the steps are captured in a single CUDA graph
+        # (the `seen` mask is updated functionally, the caller marks the returned tokens in its own copy)
+        out = []
+        for j in range(toks_positions.shape[0]):
+            toks = self.generate_one(toks, toks_positions[j:j+1], cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws)
+            if 'seen' in sampling_kws: sampling_kws['seen'] = sampling.mark_seen(sampling_kws['seen'], toks, inplace=False)
+            out.append(toks)
+        return torch.cat(out, dim=-1)
+
+    def generate_next_steps(self, *args, **kwargs):
+        return self.generate_steps(*args, **kwargs)
+
     @torch.no_grad()
     def prep(self, txt, cps=15, lang="en"):
         dev = self.device
@@ -440,61 +459,120 @@ class TSARTransformer(nn.Module):
         return ttoks, cpss, langs
     
     @torch.no_grad()
-    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, step=None, show_progress_bar=True):
+    def generate(self, txt, cps=15, lang="en", stoks_prompt=None, N=None, bs=1, T=0.7, top_k=None, top_p=None, min_p=None,
+                 repetition_penalty=None, seed=None, decode_steps=1, stop_check_every=8, step=None, show_progress_bar=True,
+                 prompt_state=None):
+        """Generates the semantic tokens for `txt`.
+
+        We stop early once every row emitted the end token, this is checked every `stop_check_every` decoding steps
+        since each check is a host sync (1 checks after every step, `None` or 0 disables it and we always generate `N`
+        tokens). `decode_steps > 1` runs several steps in a single call (and a single CUDA graph when compiled)."""
         self.ensure_tokenizer()
         N = N or self.stoks_len
         dev = self.device
-        ttoks = []
-        langs = []
-        if isinstance(lang, list):
-            lang0 = lang[0]
-            assert isinstance(txt, list), "lang and txt have to be both lists or strings"
-            for txt, lang in zip(txt, lang):
-                tt = self.tokenizer.encode(txt)
-                ttoks += tt
-                langs += [languages.to_id(lang)] * len(tt)
-        elif isinstance(lang, torch.Tensor):
-            langs = lang
-            ttoks = self.tokenizer.encode(txt)
-        else:
-            lang0 = lang
-            ttoks = self.tokenizer.encode(txt)
-            langs = torch.tensor([languages.to_id(lang)], device=dev)
-        ttoks = torch.tensor(ttoks, device=dev)
-        ttoks = F.pad(ttoks, (1, self.ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot)
-        cpss = torch.tensor([cps], device=dev)
-        T = torch.tensor(T, device=dev)
-        if not isinstance(langs, torch.Tensor):
-            langs = torch.tensor(langs, device=dev)
-            langs = F.pad(langs, (1, self.ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
+        with telemetry.stage("tokenize"):
+            ttoks = []
+            langs = []
+            if isinstance(txt, list) and isinstance(lang, str):
+                # a batch of different texts (one per row) in the same language
+                assert bs in (1, len(txt)), f"bs={bs} does not match the number of texts ({len(txt)})"
+                bs = len(txt)
+                ttoks = [self.tokenizer.encode(t) for t in txt]
+                for j,tt in enumerate(ttoks):
+                    assert len(tt) < self.ttoks_len, f"text {j} is too long ({len(tt)} tokens, the model supports up to {self.ttoks_len-1}), please split it"
+                ttoks = torch.tensor([[self.tokenizer.eot] + tt + [self.tokenizer.eot] * (self.ttoks_len - len(tt) - 1) for tt in ttoks], device=dev)
+                langs = torch.tensor([languages.to_id(lang)], device=dev)
+            elif isinstance(lang, list):
+                lang0 = lang[0]
+                assert isinstance(txt, list), "lang and txt have to be both lists or strings"
+                for txt, lang in zip(txt, lang):
+                    tt = self.tokenizer.encode(txt)
+                    ttoks += tt
+                    langs += [languages.to_id(lang)] * len(tt)
+            elif isinstance(lang, torch.Tensor):
+                langs = lang
+                ttoks = self.tokenizer.encode(txt)
+            else:
+                lang0 = lang
+                ttoks = self.tokenizer.encode(txt)
+                langs = torch.tensor([languages.to_id(lang)], device=dev)
+            if not isinstance(ttoks, torch.Tensor):
+                ttoks = torch.tensor(ttoks, device=dev)
+                ttoks = F.pad(ttoks, (1, self.ttoks_len - len(ttoks) - 1), value=self.tokenizer.eot).unsqueeze(0)
+            cpss = torch.tensor(cps if isinstance(cps, list) else [cps], device=dev)
+            if not isinstance(langs, torch.Tensor):
+                langs = torch.tensor(langs, device=dev)
+                langs = F.pad(langs, (1, self.ttoks_len - len(langs) - 1), value=languages.to_id(lang0))
+        # scalars are shared by the whole batch, lists give per-row settings
+        T, top_p, min_p, repetition_penalty = [sampling.row_param(x, dev) for x in (T, top_p, min_p, repetition_penalty)]
+        if isinstance(top_k, (list, torch.Tensor)): top_k = sampling.row_param(top_k, dev, dtype=torch.long)
 
         toks = torch.zeros((bs,N), dtype=torch.long, device=dev)
         toks[:,0] = self.stoks_codes + self.tunables.padding_token_offset
         start = 0
+        if prompt_state is not None: stoks_prompt = inference.prompt_toks(prompt_state)
         if stoks_prompt is not None:
-            toks[:,1:len(stoks_prompt)+1] = stoks_prompt
-            start = len(stoks_prompt)
-        it = range(start+1,N-1)
+            stoks_prompt = torch.as_tensor(stoks_prompt, device=dev)
+            start = stoks_prompt.shape[-1]
+            toks[:,1:start+1] = stoks_prompt
+        it = range(start+1,N-1,decode_steps)
         if show_progress_bar: it = progress_bar(it)
+        sampling_kws = dict(top_p=top_p, min_p=min_p)
+        if repetition_penalty is not None:
+            seen = torch.zeros((bs,self.stoks_codes+1), dtype=torch.bool, device=dev) # +1 for the special token
+            seen.scatter_(-1, toks[:,1:start+1], True)
+            sampling_kws.update(repetition_penalty=repetition_penalty, seen=seen)
+        if seed is not None: sampling_kws.update(seeds=sampling.row_seeds(seed, bs, dev))
 
         toks_positions = torch.arange(N, device=dev)
-        with record_function("encode"):
-            ttoks = ttoks.repeat(bs, 1)
-            langs, cpss = [x.repeat(bs) for x in (langs, cpss)]
+        with telemetry.stage("encode"):
+            ttoks, cpss = ttoks.expand(bs, -1), cpss.expand(bs)
+            langs = langs.repeat(bs)
             xenc, xenc_positions, cps_emb = self.run_encoder(ttoks, langs, cpss)
             toks_positions = torch.arange(N+1, device=dev)
         
-        with record_function("prefill"):
-            toks[:,start+1] = self.generate_one(toks[:,:start+1].contiguous(), toks_positions[:start+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-        with inference.inference_context():
+        with telemetry.stage("prefill"):
+            # with a cached prompt we only have to run the last prompt token
+            p = inference.restore_prompt_states(self.decoder, prompt_state, bs) if prompt_state is not None else 0
+            toks[:,start+1] = self.generate_one(toks[:,p:start+1].contiguous(), toks_positions[p:start+1], cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws)[:,0]
+            if repetition_penalty is not None: sampling.mark_seen(seen, toks[:,start+1:start+2])
+        eot = self.stoks_codes + self.tunables.padding_token_offset
+        # the end of generation is tracked on the device and only checked every `stop_check_every` tokens
+        # since each check forces a host sync
+        ended = toks[:,start+1] == eot
+        since_check = 0
+        with inference.inference_context(), telemetry.stage("decode"):
             for i in it:
-                toks[:,i+1] = self.generate_next(toks[:,i:i+1], toks_positions[i:i+1], cps_emb, xenc, xenc_positions, T, top_k)[:,0]
-                if (toks[:,i+1] == self.stoks_codes+self.tunables.padding_token_offset).all(): return toks[:,1:i+1]
+                n = min(decode_steps, N-1-i)
+                if n == decode_steps > 1:
+                    toks[:,i+1:i+n+1] = self.generate_next_steps(toks[:,i:i+1], toks_positions[i:i+n], cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws)
+                    if repetition_penalty is not None: sampling.mark_seen(seen, toks[:,i+1:i+n+1])
+                else:
+                    for j in range(i, i+n):
+                        toks[:,j+1] = self.generate_next(toks[:,j:j+1], toks_positions[j:j+1], cps_emb, xenc, xenc_positions, T, top_k, **sampling_kws)[:,0]
+                        if repetition_penalty is not None: sampling.mark_seen(seen, toks[:,j+1:j+2])
+                ended |= (toks[:,i+1:i+n+1] == eot).any(-1)
 
                 # for profiling, debugging or early exit
                 if step is not None: step()
+
+                since_check += n
+                if stop_check_every and since_check >= stop_check_every:
+                    since_check = 0
+                    if ended.all():
+                        # return everything up to the end of the longest row
+                        is_eot = toks[:,start+1:i+n+1] == eot
+                        return toks[:,1:start+1+is_eot.to(torch.int).argmax(-1).max()]
         return toks[:,1:]
     
+    @torch.no_grad()
+    def prompt_state(self, stoks_prompt, txt, cps=15, lang="en"):
+        """Prefills the `stoks_prompt` once (with `txt` as the text context) and returns an `inference.PromptState`
+        that can be reused by many `generate(prompt_state=...)` calls."""
+        stoks_prompt = torch.as_tensor(stoks_prompt, device=self.device).reshape(1, -1)
+        self.generate(txt, cps=cps, lang=lang, stoks_prompt=stoks_prompt, N=stoks_prompt.shape[-1]+2, show_progress_bar=False)
+        return inference.PromptState.capture(self.decoder, stoks_prompt, stoks_prompt.shape[-1])
+
     @torch.no_grad()
     def generate_batch(self, txts, N=None, T=1.1, top_k=7, show_progress_bar=True):
         self.ensure_tokenizer()
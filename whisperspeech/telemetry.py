@@ -0,0 +1,164 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Telemetry.ipynb.
+
+# %% auto 0
+__all__ = ['RequestTimings', 'stage', 'count', 'Telemetry']
+
+# %% ../nbs/D. Telemetry.ipynb 3
+import time
+import threading
+import dataclasses
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import torch
+from torch.profiler import record_function
+
+# %% ../nbs/D. Telemetry.ipynb 4
+_timings = contextvars.ContextVar('whisperspeech_timings', default=None)
+_prefix = contextvars.ContextVar('whisperspeech_stage_prefix', default='')
+
+def _synchronize():
+    if torch.cuda.is_available() and torch.cuda.is_initialized(): torch.cuda.synchronize()
+    elif torch.backends.mps.is_available(): torch.mps.synchronize()
+
+@dataclasses.dataclass
+class RequestTimings:
+    stages: dict = dataclasses.field(default_factory=lambda: defaultdict(float)) # stage name -> seconds
+    counts: dict = dataclasses.field(default_factory=lambda: defaultdict(float)) # stoks, atoks, audio_seconds
+    total: float = 0
+
+    @property
+    def rtf(self):
+        "Real-time factor (processing time / audio duration), less than 1 is faster than real-time"
+        return self.total / self.counts['audio_seconds'] if self.counts['audio_seconds'] else None
+
+    def tokens_per_second(self, model, kind):
+        decode = self.stages.get(f'{model}.decode')
+        return self.counts[kind] / decode if decode else None
+
+    def as_dict(self):
+        return dict(**self.stages, **self.counts, total=self.total, rtf=self.rtf,
+                    t2s_tokens_per_second=self.tokens_per_second('t2s', 'stoks'),
+                    s2a_tokens_per_second=self.tokens_per_second('s2a', 'atoks'))
+
+@contextmanager
+def stage(name):
+    """Marks a stage for the profiler and (inside a `Telemetry.request`) measures its duration."""
+    timings = _timings.get()
+    with record_function(name):
+        if timings is None:
+            yield
+            return
+        name = _prefix.get() + name
+        token = _prefix.set(name + '.')
+        _synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _synchronize()
+            timings.stages[name] += time.perf_counter() - start
+            _prefix.reset(token)
+
+def count(name, n):
+    """Adds `n` to a per-request counter (if we are measuring a request)."""
+    timings = _timings.get()
+    if timings is not None: timings.counts[name] += n
+
+# %% ../nbs/D. Telemetry.ipynb 5
+class Telemetry:
+    """Collects per-request timings, passes them to the `callback` and keeps totals for `prometheus()`.
+
+    Every `profile_every` requests (or on the next one after setting `profile_next`) a `torch.profiler` trace is
+    saved into `trace_dir`."""
+    def __init__(self, callback=None, profile_every=0, trace_dir='traces'):
+        self.callback = callback
+        self.profile_every = profile_every
+        self.profile_next = False
+        self.trace_dir = Path(trace_dir)
+        self.requests = 0
+        self.stage_seconds = defaultdict(float)
+        self.counts = defaultdict(float)
+        self.total_seconds = 0
+        self.lock = threading.Lock()
+
+    def _profiler(self):
+        if not (self.profile_next or self.profile_every and self.requests % self.profile_every == 0):
+            return None
+        self.profile_next = False
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+        return torch.profiler.profile(activities=activities)
+
+    @contextmanager
+    def request(self):
+        if _timings.get() is not None: # nested calls (e.g. `generate` -> `generate_atoks`) are a single request
+            yield _timings.get()
+            return
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        with self.lock:
+            prof = self._profiler()
+            n = self.requests
+            self.requests += 1
+        try:
+            with prof or nullcontext():
+                # we only time the request itself, without starting and stopping the profiler
+                start = time.perf_counter()
+                try:
+                    yield timings
+                finally:
+                    _synchronize()
+                    timings.total = time.perf_counter() - start
+        finally:
+            _timings.reset(token)
+            if prof is not None:
+                self.trace_dir.mkdir(exist_ok=True, parents=True)
+                prof.export_chrome_trace(str(self.trace_dir/f'request-{n}.json'))
+            self.record(timings)
+
+    def record(self, timings):
+        with self.lock:
+            for k,v in timings.stages.items(): self.stage_seconds[k] += v
+            for k,v in timings.counts.items(): self.counts[k] += v
+            self.total_seconds += timings.total
+        if self.callback is not None: self.callback(timings)
+
+    def prometheus(self):
+        """Returns the totals in the Prometheus text exposition format."""
+        with self.lock:
+            lines = [
+                '# TYPE whisperspeech_requests_total counter',
+                f'whisperspeech_requests_total {self.requests}',
+                '# TYPE whisperspeech_request_seconds_total counter',
+                f'whisperspeech_request_seconds_total {self.total_seconds}',
+                '# TYPE whisperspeech_stage_seconds_total counter',
+                *[f'whisperspeech_stage_seconds_total{{stage="{k}"}} {v}' for k,v in sorted(self.stage_seconds.items())],
+                '# TYPE whisperspeech_generated_total counter',
+                *[f'whisperspeech_generated_total{{kind="{k}"}} {v}' for k,v in sorted(self.counts.items())],
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9090, addr=''):
+        """Starts a background HTTP server exposing `prometheus()` at `/metrics`."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        telemetry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args): pass
+
+        server = ThreadingHTTPServer((addr, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
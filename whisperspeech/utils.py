@@ -1,11 +1,12 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: ../nbs/D. Common dataset utilities.ipynb.
 
 # %% auto 0
-__all__ = ['shard_glob', 'join_datasets', 'resampler', 'derived_name', 'derived_dataset', 'merge_in', 'AtomicTarWriter',
-           'readlines']
+__all__ = ['shard_glob', 'join_datasets', 'get_resampler', 'resample', 'resampler', 'benchmark_resampling', 'derived_name',
+           'derived_dataset', 'merge_in', 'AtomicTarWriter', 'readlines']
 
 # %% ../nbs/D. Common dataset utilities.ipynb 1
 import os
+import math
 import torch
 import torchaudio
 import torch.nn.functional as F
@@ -65,29 +66,84 @@ class join_datasets(torch.utils.data.IterableDataset):
         return sum([ds.total_samples for ds in self.datasets])
 
 # %% ../nbs/D. Common dataset utilities.ipynb 10
-def resampler(newsr = 24000, key = 'samples_24k'):
-    _last_sr = None
-    tform = None
+_resamplers = {}
+
+def get_resampler(sr, newsr, device='cpu'):
+    "A cached `torchaudio.transforms.Resample` (computing the filter kernel is a lot slower than applying it)."
+    key = (sr, newsr, str(device))
+    if key not in _resamplers: _resamplers[key] = torchaudio.transforms.Resample(sr, newsr).to(device)
+    return _resamplers[key]
+
+def resample(x, sr, newsr, device='cpu', polyphase=False):
+    if sr == newsr: return x.to(device)
+    if polyphase:
+        # scipy's polyphase FIR filter (on the CPU) is faster than the torchaudio sinc kernel for unusual rate ratios
+        from scipy.signal import resample_poly
+        g = math.gcd(sr, newsr)
+        return torch.from_numpy(resample_poly(x.cpu().numpy(), newsr // g, sr // g, axis=-1)).to(device, torch.float32)
+    return get_resampler(sr, newsr, device)(x.to(device))
+
+def resampler(newsr = 24000, key = 'samples_24k', device='cpu', batch_size=1, polyphase=False):
+    """Resamples the `samples` of every sample to `newsr` (and puts them on the `device`).
+
+    With `batch_size > 1` we stack consecutive samples with the same sampling rate and length (e.g. the padded chunks
+    from `split_to_chunks`) and resample them together, which is a lot faster on the GPU."""
+    def _flush(batch):
+        if not batch: return
+        sr = batch[0]['sample_rate']
+        out = resample(torch.stack([s['samples'] for s in batch]), sr, newsr, device=device, polyphase=polyphase)
+        for s, x in zip(batch, out):
+            s[key] = x
+            yield s
     
     def _resample(samples):
+        batch = []
         for s in samples:
-            sr = s['sample_rate']
-            if sr != newsr:
-                if sr != _last_sr: tform = torchaudio.transforms.Resample(sr, newsr)
-                s[key] = tform(s['samples'])
-            else:
-                s[key] = s['samples']
-            yield s
+            if batch and (s['sample_rate'] != batch[0]['sample_rate'] or s['samples'].shape != batch[0]['samples'].shape):
+                yield from _flush(batch)
+                batch = []
+            batch.append(s)
+            if len(batch) >= batch_size:
+                yield from _flush(batch)
+                batch = []
+        yield from _flush(batch)
     
     return _resample
 
-# %% ../nbs/D. Common dataset utilities.ipynb 11
+def benchmark_resampling(shard, newsr=16000, n_samples=100, device='cpu', batch_size=16):
+    """Measures the resampling speed (in 30 second chunks per second) on the audio files from `shard`, comparing
+    the old approach (building a new kernel for every sample) with the cached and batched resamplers."""
+    chunks = []
+    for s in wds.WebDataset(shard, shardshuffle=False).compose(wds.decode(torch_audio_opus), find_audio):
+        audio, sr = s['audio']
+        chunks.append(dict(samples=F.pad(audio[0,:30*sr], (0, max(30*sr - audio.shape[-1], 0))), sample_rate=sr))
+        if len(chunks) >= n_samples: break
+    def uncached(stream):
+        for s in stream:
+            s['out'] = torchaudio.transforms.Resample(s['sample_rate'], newsr).to(device)(s['samples'].to(device))
+            yield s
+    variants = [('uncached', uncached), ('cached', resampler(newsr, 'out', device)),
+                ('batched', resampler(newsr, 'out', device, batch_size=batch_size))]
+    try:
+        import scipy
+        variants.append(('polyphase', resampler(newsr, 'out', device, polyphase=True)))
+    except ImportError:
+        pass
+    results = {}
+    for name, fun in variants:
+        start = time.perf_counter()
+        for s in fun(dict(x) for x in chunks): pass
+        if str(device).startswith('cuda'): torch.cuda.synchronize()
+        results[name] = len(chunks) / (time.perf_counter() - start)
+    return results
+
+# %% ../nbs/D. Common dataset utilities.ipynb 12
 def derived_name(url, kind, suffix=None):
     if suffix is None: suffix = '' if url.endswith('.gz') else ".gz"
     url = Path(url)
     return str(url.parent.parent/kind/url.name) + suffix
 
-# %% ../nbs/D. Common dataset utilities.ipynb 12
+# %% ../nbs/D. Common dataset utilities.ipynb 13
 def derived_dataset(kind, suffix=None, decoders=[]):
     def deriver(url):
         return wds.WebDataset(
@@ -95,7 +151,7 @@ def derived_dataset(kind, suffix=None, decoders=[]):
         ).decode(*decoders)
     return deriver
 
-# %% ../nbs/D. Common dataset utilities.ipynb 13
+# %% ../nbs/D. Common dataset utilities.ipynb 14
 def merge_in(dataset_fun):
     """Merge a dataset into the current one returning samples with the union of keys. Pass in a function
     that takes a URL of a sample and returns a dataset for it (called everytime the URL changes).
@@ -129,17 +185,26 @@ def merge_in(dataset_fun):
             yield news
     return merge_loop
 
-# %% ../nbs/D. Common dataset utilities.ipynb 14
+# %% ../nbs/D. Common dataset utilities.ipynb 15
 def split_to_chunks(stream, ikey='vad.npy', copy_keys=[], split_keys=[], pad_to_seconds=30, random_shift=False):
+    """Splits the audio into the `ikey` chunks. With `lazy_audio` the whole file is decoded once, unless a `mask.npy`
+    selects less than half of the chunks, then we seek to each of them instead.
+    
+    `total_seconds` is `None` for samples without chunks and for containers that don't store the length."""
     for s in stream:
-        audio, sr = s['audio']
+        src = s['audio'] if isinstance(s['audio'], AudioSource) else AudioSource(decoded=s['audio'])
         chunks = s[ikey]
         imax = len(chunks) - 1
+        # seeking to every chunk is slower than decoding the file once so we only do it for a small subset
+        subset = 'mask.npy' in s and 2 * sum(s['mask.npy']) < len(chunks)
+        if len(chunks) and not subset: src.load()
+        total_seconds = src.duration if len(chunks) else None
         for i,(ts,te) in enumerate(chunks):
             if 'mask.npy' in s and not s['mask.npy'][i]:
                 # used for fishing out samples in validation sets, see also "3D. Split out validation"
                 continue
-            samples = audio[0,int(ts*sr):int(te*sr)]
+            samples, sr = src.chunk(ts, te)
+            samples = samples[0]
             if pad_to_seconds is not None:
                 padding = pad_to_seconds*sr-samples.shape[-1]
                 lpad = random.randint(0, padding) if random_shift else 0
@@ -148,7 +213,7 @@ def split_to_chunks(stream, ikey='vad.npy', copy_keys=[], split_keys=[], pad_to_
                     "src_key": s['__key__'],
                     "__url__": s['__url__'],
                     "i": i, "imax": imax,
-                    "tstart": ts, "tend": te, "total_seconds": audio.shape[-1]/sr,
+                    "tstart": ts, "tend": te, "total_seconds": total_seconds,
                     "lpad": lpad, "rpad": padding-lpad,
                     "lpad_s": lpad/sr, "rpad_s": (padding-lpad)/sr,
                     "samples": samples, "sample_rate": sr,
@@ -159,11 +224,13 @@ def split_to_chunks(stream, ikey='vad.npy', copy_keys=[], split_keys=[], pad_to_
                 subs[k] = s[k][i]
             yield subs
 
-# %% ../nbs/D. Common dataset utilities.ipynb 15
+# %% ../nbs/D. Common dataset utilities.ipynb 16
+import io
 import re
+import time
 import tempfile
 
-# %% ../nbs/D. Common dataset utilities.ipynb 16
+# %% ../nbs/D. Common dataset utilities.ipynb 17
 # a patch to ignore invalid utf-8 metadata
 import torio.io._streaming_media_decoder
 def new_parse_si(i):
@@ -211,6 +278,8 @@ def new_parse_si(i):
     )
 torio.io._streaming_media_decoder._parse_si = new_parse_si
 
+audio_extensions = ["flac", "mp3", "sox", "wav", "m4a", "ogg", "wma", "opus"]
+
 def torch_audio_opus(key, data):
     """Decode audio using the torchaudio library.
 
@@ -218,9 +287,16 @@ def torch_audio_opus(key, data):
     :param data: data to be decoded
     """
     extension = re.sub(r".*[.]", "", key)
-    if extension not in ["flac", "mp3", "sox", "wav", "m4a", "ogg", "wma", "opus"]:
+    if extension not in audio_extensions:
         return None
 
+    try:
+        return decode_audio(data, extension)
+    except RuntimeError:
+        # without a file name ffmpeg has to guess the format from the contents alone which may not always work
+        return decode_audio_tempfile(data, extension)
+
+def decode_audio_tempfile(data, extension):
     import torchaudio
 
     with tempfile.TemporaryDirectory() as dirname:
@@ -229,7 +305,90 @@ def torch_audio_opus(key, data):
             stream.write(data)
         return torchaudio.load(fname, backend='soundfile' if extension == "mp3" else None)
 
-# %% ../nbs/D. Common dataset utilities.ipynb 17
+def decode_audio(data, extension=None, ts=None, te=None):
+    """Decodes audio from `data` (bytes or a file-like object) in memory.
+
+    If `ts` or `te` (in seconds) are given we seek to `ts` and stop decoding at `te` instead of decoding the whole
+    file."""
+    import torchaudio
+
+    backend = 'soundfile' if extension == "mp3" else None
+    f = io.BytesIO(data) if isinstance(data, (bytes, bytearray, memoryview)) else data
+    if ts is None and te is None: return torchaudio.load(f, backend=backend)
+    ts = ts or 0
+    if backend == 'soundfile':
+        # libsndfile seeks by itself
+        sr = torchaudio.info(f, backend=backend).sample_rate
+        f.seek(0)
+        n = -1 if te is None else max(int(te*sr) - int(ts*sr), 0)
+        return torchaudio.load(f, frame_offset=int(ts*sr), num_frames=n, backend=backend)
+
+    reader = torchaudio.io.StreamReader(f)
+    info = reader.get_src_stream_info(reader.default_audio_stream)
+    sr = int(info.sample_rate)
+    n = None if te is None else max(int(te*sr) - int(ts*sr), 0)
+    reader.add_basic_audio_stream(frames_per_chunk=sr)
+    if ts > 0: reader.seek(ts, 'precise')
+    chunks, total = [], 0
+    for chunk, in reader.stream():
+        if chunk is None: continue
+        chunks.append(chunk)
+        total += chunk.shape[0]
+        if n is not None and total >= n: break
+    if not chunks: return torch.zeros(info.num_channels, 0), sr
+    return torch.cat(chunks).T[:, :n], sr
+
+class AudioSource:
+    """Encoded audio `data` that is decoded only when needed, either as a whole (`load`) or in time ranges (`chunk`)."""
+    def __init__(self, data=None, extension=None, decoded=None):
+        self.data, self.extension, self.decoded = data, extension, decoded
+
+    def load(self):
+        if self.decoded is None: self.decoded = torch_audio_opus(f"audio.{self.extension}", self.data)
+        return self.decoded
+
+    def chunk(self, ts, te):
+        if self.decoded is None:
+            try:
+                return decode_audio(self.data, self.extension, ts, te)
+            except RuntimeError:
+                pass # the format was not recognized without a file name, see `torch_audio_opus`
+        audio, sr = self.load()
+        return audio[:,int(ts*sr):int(te*sr)], sr
+
+    @property
+    def duration(self):
+        if self.decoded is not None: return self.decoded[0].shape[-1] / self.decoded[1]
+        import torchaudio
+        try:
+            info = torchaudio.info(io.BytesIO(self.data), backend='soundfile' if self.extension == "mp3" else None)
+        except RuntimeError: # the format was not recognized without a file name, see `torch_audio_opus`
+            audio, sr = self.load()
+            return audio.shape[-1] / sr
+        # some containers don't store the length
+        return info.num_frames / info.sample_rate if info.num_frames else None
+
+def lazy_audio(key, data):
+    """Like `torch_audio_opus` but returns an `AudioSource` so we can decode only the parts of the file we need."""
+    extension = re.sub(r".*[.]", "", key)
+    if extension not in audio_extensions:
+        return None
+    return AudioSource(data, extension)
+
+def benchmark_decoding(shard, n_samples=100):
+    "Measures the audio decoding speed (in samples per second) with and without the temporary files."
+    raw = []
+    for s in wds.WebDataset(shard, shardshuffle=False):
+        raw += [(v, ext) for k,v in s.items() if (ext := re.sub(r".*[.]", "", k)) in audio_extensions]
+        if len(raw) >= n_samples: break
+    results = {}
+    for name, fun in [('tempfile', decode_audio_tempfile), ('in-memory', decode_audio)]:
+        start = time.perf_counter()
+        for data, ext in raw: fun(data, ext)
+        results[name] = len(raw) / (time.perf_counter() - start)
+    return results
+
+# %% ../nbs/D. Common dataset utilities.ipynb 20
 def find_audio(stream, okey='audio', ikeys='flac;mp3;sox;wav;m4a;ogg;wma;opus'):
     ikeys = ikeys.split(';')
     for s in stream:
@@ -240,16 +399,16 @@ def find_audio(stream, okey='audio', ikeys='flac;mp3;sox;wav;m4a;ogg;wma;opus'):
                 break
             # implicitly skips elements without any audio
 
-# %% ../nbs/D. Common dataset utilities.ipynb 18
+# %% ../nbs/D. Common dataset utilities.ipynb 21
 def vad_dataset(shards, ikey='vad.npy', kind='vad'):
     return wds.WebDataset(shards).compose(
-        wds.decode(torch_audio_opus),
+        wds.decode(lazy_audio),
         find_audio,
         merge_in(derived_dataset(kind)),
         lambda x: split_to_chunks(x, ikey=ikey),
     )
 
-# %% ../nbs/D. Common dataset utilities.ipynb 19
+# %% ../nbs/D. Common dataset utilities.ipynb 22
 @contextmanager
 def AtomicTarWriter(name, throwaway=False):
     Path(name).parent.mkdir(exist_ok=True, parents=True)
@@ -259,7 +418,7 @@ def AtomicTarWriter(name, throwaway=False):
     if not throwaway:
         os.rename(tmp, name)
 
-# %% ../nbs/D. Common dataset utilities.ipynb 20
+# %% ../nbs/D. Common dataset utilities.ipynb 23
 def readlines(fname):
     with open(fname) as file:
         return [line.rstrip() for line in file]
@@ -5,7 +5,10 @@ __all__ = []
 
 # %% ../nbs/1B. Voice activity detection.ipynb 3
 import os
+import math
 import random
+import collections
+import multiprocessing
 import torch
 import torchaudio
 
@@ -14,6 +17,7 @@ from fastprogress import progress_bar
 from fastcore.script import call_parse
 
 import numpy as np
+import torch.nn.functional as F
 import webdataset as wds
 
 import whisperx
@@ -32,9 +36,44 @@ def segment_audio(vad_model, audio, sr=16000):
     return extract_segments(vad_result, 30)
 
 # %% ../nbs/1B. Voice activity detection.ipynb 8
+def block_energies(wav, sample_rate, chunk_seconds=600, warmup_seconds=1):
+    """The K-weighted mean square of every 400 ms BS.1770 gating block (with a 100 ms step), same as in
+    `torchaudio.functional.loudness`.
+
+    We filter the audio in `chunk_seconds` pieces so the memory use does not grow with the file length. Each piece
+    starts `warmup_seconds` early so the IIR filters settle before the first block and ends with the samples
+    needed to complete its last block."""
+    gate = int(round(0.4 * sample_rate))
+    step = int(round(gate * 0.25))
+    chunk = max(1, round(chunk_seconds * sample_rate / step)) * step
+    warmup = int(warmup_seconds * sample_rate)
+    energies = []
+    for start in range(0, max(wav.shape[-1] - gate + 1, 0), chunk):
+        x = wav[..., max(start - warmup, 0):start + chunk + gate - step]
+        x = torchaudio.functional.treble_biquad(x, sample_rate, 4.0, 1500.0, 1 / math.sqrt(2))
+        x = torchaudio.functional.highpass_biquad(x, sample_rate, 38.0, 0.5)
+        x = x[..., min(start, warmup):]
+        energies.append(x.square().unfold(-1, gate, step).mean(-1))
+    if not energies: return wav.new_zeros(*wav.shape[:-1], 0)
+    return torch.cat(energies, -1)
+
+def loudness(wav, sample_rate, **kwargs):
+    """Integrated ITU-R BS.1770-4 loudness (in LKFS) computed from `block_energies`, it gives the same results as
+    `torchaudio.transforms.Loudness` but works for arbitrarily long recordings."""
+    if wav.shape[-2] > 5: raise ValueError("Only up to 5 channels are supported.")
+    energy = block_energies(wav, sample_rate, **kwargs)
+    g = torch.tensor([1.0, 1.0, 1.0, 1.41, 1.41], dtype=energy.dtype, device=energy.device)[:energy.shape[-2]]
+    block_loudness = -0.691 + 10 * torch.log10((g[:,None] * energy).sum(-2))
+    def gated_loudness(gate):
+        return -0.691 + 10 * torch.log10((g * (energy * gate).sum(-1) / gate.count_nonzero(-1)).sum(-1))
+    # absolute gating followed by the relative gating 10 LU below the absolutely gated loudness
+    gate = block_loudness > -70
+    gate &= block_loudness > gated_loudness(gate) - 10
+    return gated_loudness(gate)
+
 # from https://huggingface.co/spaces/facebook/MusicGen/blob/9cae843238aad3f5c7695a40c9ee77c42dd87aaf/audiocraft/data/audio_utils.py
 def normalize_loudness(wav: torch.Tensor, sample_rate: int, loudness_headroom_db: float = 14,
-                       loudness_compressor: bool = False, energy_floor: float = 2e-3):
+                       loudness_compressor: bool = False, energy_floor: float = 2e-3, inplace: bool = False):
     """Normalize an input signal to a user loudness in dB LKFS.
     Audio loudness is defined according to the ITU-R BS.1770-4 recommendation.
     Args:
@@ -43,63 +82,102 @@ def normalize_loudness(wav: torch.Tensor, sample_rate: int, loudness_headroom_db
         loudness_headroom_db (float): Target loudness of the output in dB LUFS.
         loudness_compressor (bool): Uses tanh for soft clipping.
         energy_floor (float): anything below that RMS level will not be rescaled.
+        inplace (bool): Rescales `wav` in place instead of allocating another copy of the audio.
     Returns:
         torch.Tensor: Loudness normalized output data.
     """
-    energy = wav.pow(2).mean().sqrt().item()
+    energy = (wav.norm() / wav.numel() ** .5).item()
     if energy < energy_floor:
         return wav, 0
-    transform = torchaudio.transforms.Loudness(sample_rate)
-    input_loudness_db = transform(wav).item()
+    input_loudness_db = loudness(wav, sample_rate).item()
     # calculate the gain needed to scale to the desired loudness level
     delta_loudness = -loudness_headroom_db - input_loudness_db
     gain = 10.0 ** (delta_loudness / 20.0)
-    output = gain * wav
+    output = wav.mul_(gain) if inplace else gain * wav
     if loudness_compressor:
-        output = torch.tanh(output)
-    assert output.isfinite().all(), (input_loudness_db, wav.pow(2).mean().sqrt())
+        output = output.tanh_()
+    assert output.isfinite().all(), (input_loudness_db, energy)
     return output, gain
 
-# %% ../nbs/1B. Voice activity detection.ipynb 9
+# %% ../nbs/1B. Voice activity detection.ipynb 10
+def segment_powers(audio, sr, segments, frame=160):
+    """The log mean power of the `audio` inside every `(start, end)` segment (in seconds), without a loop over them.
+
+    We keep a cumulative sum of the power over `frame` sample blocks (so it stays small even for multi-hour files)
+    and add the partial blocks at the segment boundaries."""
+    if not len(segments): return torch.zeros(0)
+    sq = audio.pow(2).sum(0)
+    n = sq.shape[-1]
+    frame_sums = F.pad(sq, (0, -n % frame)).view(-1, frame).sum(-1, dtype=torch.float64)
+    cum = F.pad(frame_sums.cumsum(0), (1, 0))
+    def prefix(i): # sum(sq[:i]) for a vector of sample indices
+        offsets = torch.arange(frame)
+        idx = ((i // frame * frame)[:,None] + offsets).clamp(max=n-1)
+        partial = (sq[idx] * (offsets < (i % frame)[:,None])).sum(-1, dtype=torch.float64)
+        return cum[i // frame] + partial
+    ts, te = (torch.as_tensor(segments, dtype=torch.float64) * sr).to(torch.long).clamp(0, n).T
+    return ((prefix(te) - prefix(ts)) / ((te - ts) * audio.shape[0])).log().to(torch.float32)
+
+def load_vad(model='whisperx'):
+    "Returns a function that takes `(audio, sr)` and returns a list of `(start, end)` speech segments."
+    if model == 'whisperx':
+        vad_model = whisperx.vad.load_vad_model(get_compute_device())
+        return lambda audio, sr: segment_audio(vad_model, audio, sr=sr)
+    elif model == 'pyannote':
+        from pyannote.audio import Pipeline
+        pyannote_vad = Pipeline.from_pretrained("pyannote/voice-activity-detection")
+        return lambda audio, sr: [(x.start, x.end)
+                                  for x in pyannote_vad({"waveform":audio,"sample_rate":sr}).get_timeline().support()]
+    raise ValueError(f"unknown VAD model: {model}")
+
+def prepare_audio(s):
+    "Decodes and normalizes a raw (undecoded) shard sample, returns `None` if it has no audio."
+    ext = next((ext for ext in utils.audio_extensions if ext in s), None)
+    if ext is None: return None
+    audio, sr = utils.torch_audio_opus(ext, s[ext])
+    shift = audio.mean()
+    audio, gain = normalize_loudness(audio - shift, sr, inplace=True)
+    return dict(__key__=s['__key__'], audio=audio, sr=sr, gain=gain, shift=shift)
+
+def bounded_imap(pool, fun, xs, depth):
+    """Like `pool.imap` but reads `xs` lazily and keeps at most `depth` tasks in flight, so a slow consumer does not
+    let the raw and decoded samples pile up in memory."""
+    pending = collections.deque()
+    for x in xs:
+        pending.append(pool.apply_async(fun, (x,)))
+        if len(pending) >= depth: yield pending.popleft().get()
+    while pending: yield pending.popleft().get()
+
+# %% ../nbs/1B. Voice activity detection.ipynb 12
 @call_parse
 def process_shard(
     input:str,           # input shard URL/path
     output:str,          # output shard URL/path
     key:str='audio',     # string to replace with 'vad' in the shard name
-    model:str='whisperx' # VAD model to use (possible values: `whisperx` or `pyannote`)
+    model:str='whisperx',# VAD model to use (possible values: `whisperx` or `pyannote`)
+    workers:int=4,       # processes decoding and normalizing the audio in parallel
 ):  
-    ds = wds.WebDataset(url).compose(
-        wds.decode(utils.torch_audio_opus),
-        utils.find_audio,
-    )
-    dl = torch.utils.data.DataLoader(ds, num_workers=1, batch_size=None)
-    
-    if model == 'whisperx':
-        vad_model = whisperx.vad.load_vad_model(get_compute_device())
-    elif model == 'pyannote':
-        from pyannote.audio import Pipeline
-        pyannote_vad = Pipeline.from_pretrained("pyannote/voice-activity-detection")
-    
-    def calc_power(audio, sr, ts, te):
-        snd = audio[:,int(ts*sr):int(te*sr)]
-        return (snd*snd).mean().log()
-    
-    with utils.AtomicTarWriter(output) as sink:
-        for s in progress_bar(dl, total='noinfer'):
-            audio, sr = s['audio']
-            ash = audio.shape
-            shift = audio.mean()
-            # only normalize the first 2 hours (it fails with OOM for 7.5 hour file)
-            audio, gain = normalize_loudness(audio[:,:sr*3600*2] - shift, sr)
-            if model == 'whisperx':
-                segments = segment_audio(vad_model, audio, sr=sr)
-            elif model == 'pyannote':
-                segments = [(x.start, x.end)
-                            for x in pyannote_vad({"waveform":audio,"sample_rate":sr}).get_timeline().support()]
-            powers = [calc_power(audio, sr, ts, te) for ts, te in segments]
-            sink.write({
-                "__key__": s['__key__'],
-                "gain_shift.npy": np.array([gain, shift], dtype=np.float32),
-                "vad.npy": np.array(segments, dtype=np.float32),
-                "powers.npy": np.array(powers, dtype=np.float32),
-            })
+    # we read the shard once and send the raw samples to the workers, the results come back in order
+    # (the workers are forked before we load the VAD model so they don't inherit the GPU context)
+    pool = multiprocessing.get_context('fork').Pool(workers) if workers else None
+    raw = wds.WebDataset(input, shardshuffle=False)
+    samples = bounded_imap(pool, prepare_audio, raw, 2*workers) if pool else map(prepare_audio, raw)
+    try:
+        vad = load_vad(model)
+        with utils.AtomicTarWriter(output) as sink:
+            for p in progress_bar(samples, total='noinfer'):
+                if p is None: continue # samples without audio
+                segments = vad(p['audio'], p['sr'])
+                sink.write({
+                    "__key__": p['__key__'],
+                    "gain_shift.npy": np.array([p['gain'], p['shift']], dtype=np.float32),
+                    "vad.npy": np.array(segments, dtype=np.float32),
+                    "powers.npy": segment_powers(p['audio'], p['sr'], segments).numpy(),
+                })
+    except BaseException:
+        if pool: pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
@@ -199,7 +199,7 @@ def find_vad_kind(kind):
 def chunked_audio_dataset(shards, kind='max', copy_keys=['gain_shift.npy'], split_keys=['spk_emb.npy'],
                           resampled=False, nodesplitter=wds.shardlists.single_node_only):
     return wds.WebDataset(shards, resampled=resampled, nodesplitter=nodesplitter).compose(
-        wds.decode(utils.torch_audio_opus),
+        wds.decode(utils.lazy_audio),
         utils.find_audio,
         utils.merge_in(utils.derived_dataset('mvad')),
         find_vad_kind(kind),